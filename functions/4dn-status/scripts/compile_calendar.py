@@ -0,0 +1,151 @@
+"""
+Validates a calendar.json file against the format described in this function's README.rst and, if it's valid,
+writes a compiled copy of it, in which each event's times (with any lead time), priority and canonical environments
+have been worked out ahead of time. The lambda uses those instead of compiling the calendar itself.
+
+Usage (from the function's folder):
+
+    python scripts/compile_calendar.py calendar.json -o calendar-compiled.json [--keep-ended-days <n>]
+                                       [--archive calendar-archive.json]
+    python scripts/compile_calendar.py calendar.json --check
+
+The compiled file is still a calendar.json file (with an extra "precompiled" key), so it can be published
+in place of the original. Events that ended long ago (by default, more than 30 days ago) are left out of it,
+and added to an archive file if one is given (see prune_calendar.py).
+"""
+
+import argparse
+import json
+import numbers
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import lambda_function  # noQA - must come after sys.path is set up
+
+from prune_calendar import DEFAULT_KEEP_ENDED_DAYS, prune_calendar, archive_events, pruning_report  # noQA
+
+
+EVENT_FIELDS = {"name", "description", "message", "priority", "start_time", "end_time", "lead_time", "affects"}
+AFFECTS_FIELDS = {"name", "environments"}
+LEAD_TIME_FIELDS = {"days", "hours", "minutes", "seconds"}
+
+
+def event_problems(event):
+    """
+    Returns a list of (is_error, description) pairs for the ways in which a calendar event doesn't follow
+    the documented format. Unexpected fields are only warned about, since they do no harm.
+    """
+    if not isinstance(event, dict):
+        return [(True, "An event must be a dictionary.")]
+    problems = []
+    for field in sorted(set(event) - EVENT_FIELDS):
+        problems.append((False, "Unexpected field %r." % field))
+    name = event.get("name")
+    if not isinstance(name, str) or not name:
+        problems.append((True, "The name is required and must be a string."))
+    if not isinstance(event.get("description", ""), str):
+        problems.append((True, "The description must be a string."))
+    priority = event.get("priority")
+    if priority is not None and priority not in lambda_function.ALL_PRIORITY_NAMES:
+        problems.append((True, "The priority must be one of %s." % ", ".join(lambda_function.ALL_PRIORITY_NAMES)))
+    times = {}
+    for field in ["start_time", "end_time"]:
+        timespec = event.get(field)
+        if timespec is None:
+            continue
+        try:
+            times[field] = lambda_function.as_epoch(timespec)
+        except Exception:
+            problems.append((True, "The %s, %r, is not a <datetime-string>." % (field, timespec)))
+    if len(times) == 2 and times["end_time"] < times["start_time"]:
+        problems.append((False, "The event ends before it starts, so it will never be shown."))
+    lead_time = event.get("lead_time")
+    if isinstance(lead_time, dict):
+        if set(lead_time) - LEAD_TIME_FIELDS:
+            problems.append((True, "A lead_time dictionary can only have the fields %s."
+                             % ", ".join(sorted(LEAD_TIME_FIELDS))))
+        if not all(isinstance(value, numbers.Real) for value in lead_time.values()):
+            problems.append((True, "The parts of a lead_time must be numbers."))
+    elif lead_time is not None and not isinstance(lead_time, numbers.Real):
+        problems.append((True, "The lead_time must be a number of seconds or a dictionary."))
+    affects = event.get("affects")
+    if affects is not None:
+        if not isinstance(affects, dict):
+            problems.append((True, "The affects field must be a dictionary."))
+        else:
+            for field in sorted(set(affects) - AFFECTS_FIELDS):
+                problems.append((False, "Unexpected field %r in affects." % field))
+            environments = affects.get("environments")
+            if environments is not None and not (isinstance(environments, list)
+                                                 and all(isinstance(env, str) for env in environments)):
+                problems.append((True, "The affected environments must be a list of strings."))
+    return problems
+
+
+def compile_calendar_file(data):
+    """
+    Validates and compiles calendar data, returning a list of (event index, is_error, description) problems
+    and the compiled data (which is None if there were any errors).
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("calendar"), list):
+        return [(None, True, 'A calendar must be a dictionary with a "calendar" list.')], None
+    problems = []
+    for i, event in enumerate(data["calendar"]):
+        problems.extend((i, is_error, description) for is_error, description in event_problems(event))
+    if any(is_error for _, is_error, _ in problems):
+        return problems, None
+    compiled_events = []
+    for i, event in enumerate(data["calendar"]):
+        compiled_event = lambda_function.compile_event(i, event)
+        if compiled_event.error:
+            problems.append((i, True, compiled_event.error))
+        compiled_events.append(compiled_event)
+    if any(is_error for _, is_error, _ in problems):
+        return problems, None
+    compiled = dict(data)
+    compiled[lambda_function.PRECOMPILED_KEY] = lambda_function.precompiled_events(compiled_events)
+    return problems, compiled
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Validates and compiles a 4dn-status calendar.json file.")
+    parser.add_argument("calendar", help="a calendar.json file")
+    parser.add_argument("-o", "--output", default=None, help="where to write the compiled calendar")
+    parser.add_argument("--check", action="store_true", default=False, help="validate only, writing nothing")
+    parser.add_argument("--keep-ended-days", type=float, default=DEFAULT_KEEP_ENDED_DAYS,
+                        help="how many days events are kept after they end (default %s)" % DEFAULT_KEEP_ENDED_DAYS)
+    parser.add_argument("--archive", default=None, help="a calendar.json file to add the removed events to")
+    parser.add_argument("--now", default=None, help="a <datetime-string> to use as the current time")
+    args = parser.parse_args(argv)
+    if not args.check and not args.output:
+        parser.error("Either --output or --check must be given.")
+    with open(args.calendar) as fp:
+        data = json.load(fp)
+    problems, compiled = compile_calendar_file(data)
+    for i, is_error, description in problems:
+        if i is None:
+            where = "calendar"
+        else:
+            event = data["calendar"][i]
+            where = "event %s (%s)" % (i, event.get("name") if isinstance(event, dict) else "unnamed")
+        print("%s: %s: %s" % ("ERROR" if is_error else "WARNING", where, description))
+    if compiled is None:
+        print("%s is not valid." % args.calendar)
+        sys.exit(1)
+    pruned, expired = prune_calendar(compiled, now=args.now, keep_ended_days=args.keep_ended_days)
+    if args.check:
+        print("%s is valid. %s events would be compiled and %s ended ones removed."
+              % (args.calendar, len(pruned["calendar"]), len(expired)))
+    else:
+        if args.archive:
+            print("Archived %s events in %s." % (archive_events(args.archive, expired), args.archive))
+        with open(args.output, 'w') as fp:
+            json.dump(pruned, fp, separators=(',', ':'))
+        print("Compiled %s events into %s." % (len(pruned["calendar"]), args.output))
+        print(pruning_report(compiled, pruned, expired, separators=(',', ':')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Sends a mix of requests like those the status page gets (production and staged paths, various referers,
+HTML and JSON, compressed and not) to a server at a given concurrency, and reports the throughput
+and the distribution of latencies.
+
+Usage (from the function's folder, with serve_locally.py running):
+
+    python scripts/load_test.py [--url http://127.0.0.1:8000] [--concurrency 8] [--requests 2000] [--json]
+"""
+
+import argparse
+import bisect
+import collections
+import json
+import math
+import random
+import threading
+import time
+
+import requests
+
+
+PATHS = ["/4dn-status"] * 4 + ["/4dn-status-staged"]
+
+REFERERS = [
+    None,
+    "https://data.4dnucleome.org/",
+    "https://staging.4dnucleome.org/",
+    "https://cgap.hms.harvard.edu/",
+    "http://fourfront-mastertest.9wzadzju3p.us-east-1.elasticbeanstalk.com/",
+    "http://fourfront-cgapwolf.9wzadzju3p.us-east-1.elasticbeanstalk.com/",
+]
+
+QUERIES = [
+    {},
+    {},
+    {"format": "json"},
+    {"application": "cgap"},
+    {"environment": "fourfront-webdev", "format": "json"},
+]
+
+ACCEPT_ENCODINGS = [None, "gzip, deflate, br"]
+
+# Upper bounds (in milliseconds) of the latency histogram's buckets. The last bucket takes everything slower.
+HISTOGRAM_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+def request_mix(seed=0):
+    """Returns an endless, repeatable sequence of (path, query parameters, headers) for requests to make."""
+    rng = random.Random(seed)
+    while True:
+        headers = {}
+        referer = rng.choice(REFERERS)
+        if referer:
+            headers["Referer"] = referer
+        accept_encoding = rng.choice(ACCEPT_ENCODINGS)
+        if accept_encoding:
+            headers["Accept-Encoding"] = accept_encoding
+        yield rng.choice(PATHS), rng.choice(QUERIES), headers
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value below which the given fraction of the (sorted) values fall, by the nearest-rank method."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def run_load(url, *, concurrency, total_requests, seed=0):
+    """Makes total_requests requests, concurrency at a time, returning the latencies, statuses and elapsed time."""
+    mix = request_mix(seed)
+    mix_lock = threading.Lock()
+    issued = [0]
+    latencies = []
+    statuses = collections.Counter()
+    results_lock = threading.Lock()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with mix_lock:
+                if issued[0] >= total_requests:
+                    return
+                issued[0] += 1
+                path, params, headers = next(mix)
+            started = time.perf_counter()
+            try:
+                status = session.get(url + path, params=params, headers=headers, timeout=30).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            with results_lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), statuses, time.perf_counter() - started
+
+
+def load_report(latencies, statuses, elapsed, *, concurrency):
+    histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+    for latency in latencies:
+        histogram[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, latency * 1000)] += 1
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed if elapsed else None,
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000 if latencies else None,
+            "p95": percentile(latencies, 0.95) * 1000 if latencies else None,
+            "p99": percentile(latencies, 0.99) * 1000 if latencies else None,
+            "max": latencies[-1] * 1000 if latencies else None,
+        },
+        "histogram": [{"up_to_ms": bound, "count": count}
+                      for bound, count in zip(HISTOGRAM_BOUNDS_MS + [None], histogram)],
+    }
+
+
+def print_report(report):
+    print("%s requests at concurrency %s in %.2f seconds: %.1f requests/second"
+          % (report["requests"], report["concurrency"], report["elapsed_seconds"], report["requests_per_second"]))
+    print("Statuses: %s" % ", ".join("%s: %s" % item for item in report["statuses"].items()))
+    print("Latency: %s" % ", ".join("%s %.1f ms" % (name, value)
+                                    for name, value in report["latency_ms"].items() if value is not None))
+    largest = max([bucket["count"] for bucket in report["histogram"]] + [1])
+    previous = 0
+    for bucket in report["histogram"]:
+        label = ("%s-%s ms" % (previous, bucket["up_to_ms"]) if bucket["up_to_ms"] is not None
+                 else "over %s ms" % previous)
+        print("%14s %7s %s" % (label, bucket["count"], "#" * round(50 * bucket["count"] / largest)))
+        previous = bucket["up_to_ms"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load tests a (local) 4dn-status server.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="the server to test (default %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once (default 8)")
+    parser.add_argument("--requests", type=int, default=2000, help="the number of requests to make (default 2000)")
+    parser.add_argument("--seed", type=int, default=0, help="chooses a different (but repeatable) mix of requests")
+    parser.add_argument("--json", action="store_true", default=False, help="report as JSON")
+    args = parser.parse_args(argv)
+    latencies, statuses, elapsed = run_load(args.url.rstrip("/"), concurrency=args.concurrency,
+                                            total_requests=args.requests, seed=args.seed)
+    report = load_report(latencies, statuses, elapsed, concurrency=args.concurrency)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Moves the events of a calendar.json file that ended long ago (by default, more than 30 days ago) into an archive file,
+so that the calendar the lambda fetches and filters stays small.
+
+Usage (from the function's folder):
+
+    python scripts/prune_calendar.py calendar.json -o calendar-pruned.json --archive calendar-archive.json
+
+The archive is itself a calendar.json file. If it already exists, the newly expired events are added to it.
+Events that could not be compiled are kept, since there's no telling when they end. If the calendar was compiled
+(see compile_calendar.py), the compiled results are pruned along with the events.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import lambda_function  # noQA - must come after sys.path is set up
+
+
+DEFAULT_KEEP_ENDED_DAYS = 30
+
+
+def prune_calendar(data, *, now=None, keep_ended_days=DEFAULT_KEEP_ENDED_DAYS):
+    """
+    Returns a copy of the calendar data without the events that ended more than keep_ended_days ago,
+    and a list of the events that were left out.
+    """
+    compiled_events = lambda_function.compile_calendar(data).events
+    _, when = lambda_function.filter_time(now)
+    horizon = when - keep_ended_days * 24 * 60 * 60
+    kept = []
+    expired = []
+    for compiled_event in compiled_events:
+        if compiled_event.error or compiled_event.end is None or compiled_event.end >= horizon:
+            kept.append(compiled_event)
+        else:
+            expired.append(compiled_event.event)
+    pruned = dict(data)
+    pruned["calendar"] = [compiled_event.event for compiled_event in kept]
+    if lambda_function.load_precompiled_events(data) is not None:
+        pruned[lambda_function.PRECOMPILED_KEY] = lambda_function.precompiled_events(kept)
+    else:
+        pruned.pop(lambda_function.PRECOMPILED_KEY, None)  # Whatever is there no longer matches the events.
+    return pruned, expired
+
+
+def archive_events(archive_file, events):
+    """Adds the given events to those in the archive file (creating it if need be), returning how many were new."""
+    archive = {"calendar": []}
+    if os.path.exists(archive_file):
+        with open(archive_file) as fp:
+            archive = json.load(fp)
+    archived = archive.setdefault("calendar", [])
+    seen = {json.dumps(event, sort_keys=True) for event in archived}
+    added = 0
+    for event in events:
+        key = json.dumps(event, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            archived.append(event)
+            added += 1
+    with open(archive_file, 'w') as fp:
+        json.dump(archive, fp, indent=4)
+    return added
+
+
+def json_size(data, **options):
+    """Returns the number of bytes the data takes up when written as JSON with the given json.dumps options."""
+    return len(json.dumps(data, **options).encode('utf-8'))
+
+
+def pruning_report(data, pruned, expired, **options):
+    """Describes how much smaller the pruned calendar is, given the json.dumps options it's written with."""
+    return ("Removed %s of %s events (%s bytes, leaving %s)."
+            % (len(expired), len(data.get("calendar") or []),
+               json_size(data, **options) - json_size(pruned, **options), json_size(pruned, **options)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archives the long-ended events of a 4dn-status calendar.json file.")
+    parser.add_argument("calendar", help="a calendar.json file")
+    parser.add_argument("-o", "--output", required=True, help="where to write the pruned calendar")
+    parser.add_argument("--archive", default=None, help="a calendar.json file to add the removed events to")
+    parser.add_argument("--keep-ended-days", type=float, default=DEFAULT_KEEP_ENDED_DAYS,
+                        help="how many days events are kept after they end (default %s)" % DEFAULT_KEEP_ENDED_DAYS)
+    parser.add_argument("--now", default=None, help="a <datetime-string> to use as the current time")
+    args = parser.parse_args(argv)
+    with open(args.calendar) as fp:
+        data = json.load(fp)
+    pruned, expired = prune_calendar(data, now=args.now, keep_ended_days=args.keep_ended_days)
+    if args.archive:
+        print("Archived %s events in %s." % (archive_events(args.archive, expired), args.archive))
+    elif expired:
+        print("WARNING: No --archive was given, so the removed events are not kept anywhere.")
+    with open(args.output, 'w') as fp:
+        json.dump(pruned, fp, indent=4)
+    print(pruning_report(data, pruned, expired, indent=4))
+
+
+if __name__ == '__main__':
+    main()
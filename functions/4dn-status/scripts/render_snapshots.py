@@ -0,0 +1,81 @@
+"""
+Renders the status page, as HTML and as JSON, for every known environment at the current time (or a given one),
+so that the results can be published to S3 and served without invoking the lambda.
+
+Usage (from the function's folder):
+
+    python scripts/render_snapshots.py calendar.json snapshots/ [--now <datetime-string>]
+
+Besides a <env>.html and <env>.json file for each environment, a manifest.json is written that says
+when each environment's status will next change. The snapshots need republishing only once that time has passed.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import lambda_function  # noQA - must come after sys.path is set up
+
+
+def snapshot_file_name(environment, extension):
+    # Environments named only by the calendar could be named anything, so keep to characters safe in a file name.
+    return "%s.%s" % (re.sub(r"[^A-Za-z0-9._-]", "_", environment), extension)
+
+
+def render_snapshots(data, output_dir, *, now=None):
+    """
+    Writes the HTML and JSON responses for each known environment into output_dir, with a manifest describing them.
+    Returns the manifest.
+    """
+    calendar = lambda_function.compiled_calendar(data)
+    filter_now, when = lambda_function.filter_time(now)
+    now = str(filter_now)  # All environments must be rendered as of the same time.
+    environments = {}
+    transitions = []
+    for environment in lambda_function.known_environments(data):
+        filtered = lambda_function.filter_data(data, environment, now=now)
+        files = {}
+        for response_format, extension in [('html', 'html'), ('json', 'json')]:
+            _, body = lambda_function.render_body(filtered, environment, response_format)
+            files[extension] = file_name = snapshot_file_name(environment, extension)
+            with open(os.path.join(output_dir, file_name), 'w') as fp:
+                fp.write(body)
+        transition = calendar.index_for(environment).next_transition(when)
+        if transition is not None:
+            transitions.append(transition)
+        environments[environment] = dict(files, **{
+            "priority": filtered["priority"],
+            "next_transition": None if transition is None else str(lambda_function.as_ref_time(transition)),
+        })
+    manifest = {
+        "rendered_at": str(lambda_function.as_ref_time(when)),
+        "calendar_version": calendar.version,
+        # The status of some environment may change at (or just after) this time.
+        "next_transition": str(lambda_function.as_ref_time(min(transitions))) if transitions else None,
+        "environments": environments,
+    }
+    with open(os.path.join(output_dir, "manifest.json"), 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Renders the 4dn-status page for every known environment.")
+    parser.add_argument("calendar", help="a calendar.json file")
+    parser.add_argument("output_dir", help="the folder to write snapshots and their manifest.json into")
+    parser.add_argument("--now", default=None, help="a <datetime-string> to render at, rather than the current time")
+    args = parser.parse_args(argv)
+    with open(args.calendar) as fp:
+        data = json.load(fp)
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = render_snapshots(data, args.output_dir, now=args.now)
+    print("Rendered %s environments into %s. Next transition: %s."
+          % (len(manifest["environments"]), args.output_dir, manifest["next_transition"] or "none"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Serves lambda_handler over HTTP on this machine, the way API Gateway (with an HTTP API) serves it on AWS,
+so that it can be tried out or load tested (see load_test.py) without deploying it.
+
+Usage (from the function's folder):
+
+    python scripts/serve_locally.py [--port 8000] [--calendar-dir data/local] [--calendar-port 8001]
+
+Each request to /4dn-status or /4dn-status-staged is made into an event like the one in data/aws_event_sample.rst
+and given to lambda_handler. If --calendar-dir is given, that folder is served (on --calendar-port) in place of S3,
+and the lambda fetches 4dn-status/calendar.json and 4dn-status/calendar-staged.json from there instead.
+Otherwise, the real calendars are fetched.
+"""
+
+import argparse
+import base64
+import datetime
+import http.server
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import uuid
+
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import lambda_function  # noQA - must come after sys.path is set up
+
+
+ROUTES = [lambda_function.PRD_ENDPOINT_PATH, lambda_function.STG_ENDPOINT_PATH]
+
+
+def make_event(method, raw_path, raw_query_string, headers, *, host, source_ip):
+    """Returns the HTTP API (payload format 2.0) event that API Gateway would give the lambda for a request."""
+    now = time.time()
+    route_key = "ANY %s" % raw_path
+    event = {
+        "version": "2.0",
+        "routeKey": route_key,
+        "rawPath": raw_path,
+        "rawQueryString": raw_query_string,
+        # API Gateway lowercases header names, and joins repeated headers with commas.
+        "headers": headers,
+    }
+    if raw_query_string:
+        event["queryStringParameters"] = {name: ",".join(values)
+                                          for name, values in parse_qs(raw_query_string).items()}
+    event["requestContext"] = {
+        "accountId": "123456789012",
+        "apiId": "local",
+        "domainName": host,
+        "domainPrefix": host.split(".")[0],
+        "http": {
+            "method": method,
+            "path": raw_path,
+            "protocol": "HTTP/1.1",
+            "sourceIp": source_ip,
+            "userAgent": headers.get("user-agent", ""),
+        },
+        "requestId": str(uuid.uuid4()),
+        "routeKey": route_key,
+        "stage": "$default",
+        "time": datetime.datetime.fromtimestamp(now, datetime.timezone.utc).strftime("%d/%b/%Y:%H:%M:%S +0000"),
+        "timeEpoch": int(now * 1000),
+    }
+    event["isBase64Encoded"] = False
+    return event
+
+
+class QuietLogging:
+    """Mixed into request handlers so that requests are logged only if their server isn't quiet."""
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class CalendarFileHandler(QuietLogging, http.server.SimpleHTTPRequestHandler):
+
+    def translate_path(self, path):
+        # SimpleHTTPRequestHandler only takes a directory to serve in Python 3.7 and later. Before that,
+        # it always serves the current directory, so the path it works out is moved to the server's directory.
+        relative_path = os.path.relpath(super().translate_path(path), os.getcwd())
+        return os.path.join(self.server.directory, relative_path)
+
+
+class ApiGatewayHandler(QuietLogging, http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # Otherwise, with connections kept alive, each response waits on the client's delayed acknowledgement.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, *, send_body):
+        parts = urlsplit(self.path)
+        if parts.path not in ROUTES:
+            self.respond(404, [("Content-Type", "application/json")], b'{"message":"Not Found"}', send_body)
+            return
+        headers = {}
+        for name, value in self.headers.items():
+            name = name.lower()
+            headers[name] = headers[name] + "," + value if name in headers else value
+        event = make_event(self.command, parts.path, parts.query, headers,
+                           host=headers.get("host", "localhost"), source_ip=self.client_address[0])
+        result = lambda_handler_result(event)
+        self.respond(result["statusCode"], result["headers"], result["body"], send_body)
+
+    def respond(self, status, headers, body, send_body):
+        self.send_response(status)
+        for name, value in headers:
+            if name.lower() != "content-length":
+                self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+# The keys of a lambda's result that API Gateway makes use of. It ignores any others.
+RESULT_KEYS = {"statusCode", "headers", "multiValueHeaders", "cookies", "body", "isBase64Encoded"}
+
+_warned_keys = set()
+
+
+def lambda_handler_result(event):
+    """
+    Calls lambda_handler, interpreting its result as API Gateway would, and returns the status code,
+    a list of (name, value) headers and the body bytes to send. As with payload format 2.0, a result without
+    a statusCode is itself the (JSON) body of a 200 response.
+
+    Like API Gateway, this ignores any other keys in the result, such as headers mistakenly put at its top level,
+    but it warns (once per key) that it's doing so.
+    """
+    result = lambda_function.lambda_handler(event, context=None)
+    if not isinstance(result, dict) or "statusCode" not in result:
+        return {"statusCode": 200, "headers": [("Content-Type", "application/json")],
+                "body": json.dumps(result).encode('utf-8')}
+    for key in sorted(set(result) - RESULT_KEYS - _warned_keys):
+        _warned_keys.add(key)
+        print("WARNING: API Gateway ignores %r in lambda_handler's result, so it is not sent." % key,
+              file=sys.stderr)
+    headers = list((result.get("headers") or {}).items())
+    for name, values in (result.get("multiValueHeaders") or {}).items():
+        headers.extend((name, value) for value in values)
+    headers.extend(("Set-Cookie", cookie) for cookie in result.get("cookies") or [])
+    body = result.get("body") or ""
+    body = base64.b64decode(body) if result.get("isBase64Encoded") else body.encode('utf-8')
+    return {"statusCode": result["statusCode"], "headers": headers, "body": body}
+
+
+class QuietHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # This is how http.server.ThreadingHTTPServer (new in Python 3.7) is made.
+    daemon_threads = True
+    quiet = False
+    directory = None  # for a CalendarFileHandler, what to serve
+
+
+def serve_calendars(directory, port, *, quiet=False):
+    """
+    Serves the given folder over HTTP on a background thread, in place of S3, and points the lambda at it.
+    (In Python 3.7 and later, If-Modified-Since is supported, so the lambda's revalidation works as with S3.)
+    """
+    server = QuietHTTPServer(("127.0.0.1", port), CalendarFileHandler)
+    server.directory = os.path.abspath(directory)
+    server.quiet = quiet
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:%s/4dn-status/" % server.server_address[1]
+    lambda_function.CALENDAR_DATA_URL_PRD = base_url + "calendar.json"
+    lambda_function.CALENDAR_DATA_URL_STG = base_url + "calendar-staged.json"
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serves the 4dn-status lambda locally, as API Gateway would.")
+    parser.add_argument("--port", type=int, default=8000, help="the port to serve the lambda on (default 8000)")
+    parser.add_argument("--calendar-dir", default=None,
+                        help="a folder containing 4dn-status/calendar.json (and calendar-staged.json) to serve"
+                             " in place of S3")
+    parser.add_argument("--calendar-port", type=int, default=8001,
+                        help="the port to serve --calendar-dir on (default 8001)")
+    parser.add_argument("--quiet", action="store_true", default=False, help="don't log each request")
+    args = parser.parse_args(argv)
+    if args.calendar_dir:
+        serve_calendars(args.calendar_dir, args.calendar_port, quiet=args.quiet)
+        print("Serving calendars from %s in place of S3." % args.calendar_dir)
+    server = QuietHTTPServer(("127.0.0.1", args.port), ApiGatewayHandler)
+    server.quiet = args.quiet
+    print("Serving %s at http://127.0.0.1:%s" % (" and ".join(ROUTES), args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
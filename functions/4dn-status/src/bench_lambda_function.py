@@ -0,0 +1,173 @@
+"""
+Benchmarks for the stages of handling a request, over synthetic calendars of various sizes.
+
+Run from the function's folder (the one containing src/) with:
+
+    python -m src.bench_lambda_function [--sizes 10,100,1000,10000,100000] [--output bench.json]
+
+The calendar is never fetched; lambda_handler is given the synthetic calendar instead.
+Results are written as JSON, so that runs (e.g., before and after a change) can be compared.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+from dcicutils.misc_utils import ref_now
+from unittest import mock
+from . import lambda_function as lambda_function_module
+from .lambda_function import (
+    lambda_handler, compile_calendar, compiled_calendar, filter_data, convert_to_html, render_body,
+    resolve_environment, clear_environment_memos, RESPONSE_CACHE,
+)
+from .test_lambda_function import SAMPLE_EVENTS, event_with_qs_params, MASTERTEST_SERVER
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+ENVIRONMENTS = [
+    "fourfront-webprod", "fourfront-mastertest", "fourfront-hotseat", "fourfront-webdev", "fourfront-wolf",
+    "fourfront-cgap", "fourfront-cgapwolf", "fourfront-cgaptest", "fourfront-cgapdev", "fourfront-cgaphotseat",
+]
+
+BENCHMARK_ENVIRONMENT = "fourfront-mastertest"
+
+
+def synthetic_calendar(size, *, seed=0, now=None):
+    """
+    Returns calendar data with the given number of events shaped like SAMPLE_EVENTS, spread over two years
+    either side of now. Some events are open-ended at one end or the other, some have a lead time,
+    some affect several environments and some affect all of them.
+    """
+    rng = random.Random(seed)
+    now = now or ref_now()
+    events = []
+    for i in range(size):
+        template = SAMPLE_EVENTS[i % len(SAMPLE_EVENTS)]
+        start = now + datetime.timedelta(days=rng.uniform(-730, 730))
+        end = start + datetime.timedelta(hours=rng.choice([1, 4, 24, 24 * 7, 24 * 90]))
+        event = dict(template, name="%s #%s" % (template["name"], i))
+        shape = rng.random()
+        if shape < 0.1:
+            del event["start_time"]
+        else:
+            event["start_time"] = start.strftime("%Y-%m-%d %H:%M:%S%z")
+        if 0.1 <= shape < 0.2:
+            del event["end_time"]
+        else:
+            event["end_time"] = end.strftime("%Y-%m-%d %H:%M:%S%z")
+        if rng.random() < 0.3:
+            event["lead_time"] = rng.choice([3600, {"days": 1}, {"hours": 12, "minutes": 30}])
+        if rng.random() < 0.15:
+            event.pop("affects")
+        else:
+            event["affects"] = {"name": "Some Systems",
+                                "environments": rng.sample(ENVIRONMENTS, rng.choice([1, 1, 2, 4]))}
+        if rng.random() < 0.5:
+            event["priority"] = rng.choice(lambda_function_module.ALL_PRIORITY_NAMES)
+        events.append(event)
+    return {"calendar": events}
+
+
+def measure(function, *, min_seconds=0.2, max_calls=1000):
+    """
+    Calls the function repeatedly, for at least min_seconds (but at least twice and at most max_calls times),
+    returning statistics about the time per call.
+    """
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < 2 or (time.perf_counter() - started < min_seconds and len(timings) < max_calls):
+        call_started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - call_started)
+    return {
+        "calls": len(timings),
+        "best_seconds": min(timings),
+        "median_seconds": statistics.median(timings),
+        "mean_seconds": statistics.mean(timings),
+    }
+
+
+def benchmark_environments():
+    """Benchmarks environment resolution, which doesn't depend on the calendar."""
+
+    def resolve():
+        resolve_environment(host=None, referer=MASTERTEST_SERVER, application=None, environment=None)
+
+    def resolve_cold():
+        clear_environment_memos()
+        resolve()
+
+    return {"resolve_environment": measure(resolve), "resolve_environment_cold": measure(resolve_cold)}
+
+
+def benchmark_calendar(data):
+    """Benchmarks each stage of handling a request about BENCHMARK_ENVIRONMENT with the given calendar data."""
+    results = {}
+    results["compile_calendar"] = measure(lambda: compile_calendar(data), max_calls=20)
+    compiled_calendar(data)
+    results["filter_data"] = measure(lambda: filter_data(data, BENCHMARK_ENVIRONMENT))
+    filtered = filter_data(data, BENCHMARK_ENVIRONMENT)
+    results["convert_to_html"] = measure(lambda: convert_to_html(filtered, BENCHMARK_ENVIRONMENT))
+    results["render_json"] = measure(lambda: render_body(filtered, BENCHMARK_ENVIRONMENT, 'json'))
+    event = event_with_qs_params(environment=BENCHMARK_ENVIRONMENT)
+    current_data = [data]
+    with mock.patch.object(lambda_function_module, "get_calendar_data", lambda staged: current_data[0]):
+
+        def handle_new_calendar():
+            # A calendar not seen before must be compiled.
+            current_data[0] = dict(data)
+            RESPONSE_CACHE.clear()
+            lambda_handler(event, context=None)
+
+        def handle_uncached():
+            RESPONSE_CACHE.clear()
+            lambda_handler(event, context=None)
+
+        def handle_cached():
+            lambda_handler(event, context=None)
+
+        results["lambda_handler_new_calendar"] = measure(handle_new_calendar, max_calls=20)
+        current_data[0] = data
+        results["lambda_handler_uncached"] = measure(handle_uncached)
+        results["lambda_handler_cached"] = measure(handle_cached)
+    results["active_events"] = len(filtered["calendar"])
+    return results
+
+
+def run_benchmarks(sizes):
+    results = {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "environments": benchmark_environments(),
+        "calendars": {},
+    }
+    for size in sizes:
+        print("Benchmarking a calendar of %s events ..." % size, file=sys.stderr)
+        results["calendars"][str(size)] = benchmark_calendar(synthetic_calendar(size))
+    RESPONSE_CACHE.clear()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the 4dn-status lambda over synthetic calendars.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated numbers of calendar events (default %(default)s)")
+    parser.add_argument("--output", default=None, help="a file to write the JSON results to (default: stdout)")
+    args = parser.parse_args(argv)
+    results = run_benchmarks([int(size) for size in args.sizes.split(",")])
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
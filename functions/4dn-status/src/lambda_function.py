@@ -1,14 +1,40 @@
+import base64
+import bisect
+import collections
 import datetime
+import functools
+import gzip
+import hashlib
+import heapq
 import html
 import io
 import json
+import math
+import os
+import re
 import requests
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
 
 from dcicutils.misc_utils import (
-    ref_now, as_datetime, in_datetime_interval, ignored, full_class_name, as_ref_datetime, as_seconds, remove_prefix,
+    ref_now, as_datetime, ignored, full_class_name, as_ref_datetime, as_seconds, remove_prefix, REF_TZ,
 )
 from dcicutils.env_utils import classify_server_url, prod_bucket_env_for_app, get_bucket_env, is_cgap_env
 
+try:
+    import brotli
+except ImportError:  # brotli is optional. Without it, only gzip is offered.
+    brotli = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional. Without it, the standard json module is used.
+    orjson = None
+
 
 PRIORITY_RED = 'red'
 PRIORITY_ORANGE = 'orange'
@@ -61,76 +87,315 @@ CALENDAR_MISSING_MESSAGE = "Calendar data is unavailable."
 CALENDAR_MISSING_PRIORITY = PRIORITY_RED
 
 
+def _env_number(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return float(default)
+
+
+def _env_flag(name, default=False):
+    value = os.environ.get(name)
+    return default if value is None else value.upper() == "TRUE"
+
+
+# How long a fetched calendar is trusted before S3 is consulted again.
+CALENDAR_CACHE_TTL_SECONDS = _env_number("CALENDAR_CACHE_TTL_SECONDS", 60)
+# How long the last good calendar can still be served if S3 cannot be reached.
+CALENDAR_CACHE_MAX_STALENESS_SECONDS = _env_number("CALENDAR_CACHE_MAX_STALENESS_SECONDS", 3600)
+# Whether an expired calendar is served immediately while a fresh one is fetched in the background.
+CALENDAR_STALE_WHILE_REVALIDATE = _env_flag("CALENDAR_STALE_WHILE_REVALIDATE")
+
+
+class CalendarCacheEntry:
+
+    __slots__ = ('data', 'fetched_at', 'checked_at', 'etag', 'last_modified', 'size')
+
+    def __init__(self, data, fetched_at, *, etag=None, last_modified=None, size=0):
+        self.data = data
+        self.fetched_at = fetched_at  # when this data was last known good
+        self.checked_at = fetched_at  # when we last tried to get newer data
+        # These are the S3 validators that let us ask for the calendar only if it has changed.
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size  # the number of bytes in the body we were sent
+
+
+class CalendarCache:
+    """
+    Remembers the most recent good copy of each calendar (production and staged) across warm invocations.
+
+    An entry is served without consulting S3 until ttl_seconds have passed since it was last checked.
+    After that, it is revalidated with a conditional request, so an unchanged calendar is neither
+    downloaded nor parsed again. If a refetch fails, the last good copy continues to be served (and is
+    rechecked no more often than every ttl_seconds) until it is more than max_staleness_seconds old,
+    after which the failure is reported.
+
+    If stale_while_revalidate is true, an expired (but not too stale) entry is served right away
+    and refreshed on a background thread. In a lambda, that thread is frozen along with the container
+    between invocations, so the refresh may complete during a later invocation; in a long-running server
+    it completes as soon as the fetch does. Either way, at most one fetch per key is under way at a time.
+    """
+
+    def __init__(self, *, ttl_seconds=CALENDAR_CACHE_TTL_SECONDS,
+                 max_staleness_seconds=CALENDAR_CACHE_MAX_STALENESS_SECONDS,
+                 stale_while_revalidate=CALENDAR_STALE_WHILE_REVALIDATE, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_staleness_seconds = max_staleness_seconds
+        self.stale_while_revalidate = stale_while_revalidate
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.refreshing = {}
+        self.clear()
+
+    def clear(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.not_modified = 0
+        self.bytes_saved = 0
+        self.parses_saved = 0
+        self.background_refreshes = 0
+
+    def key_lock(self, key):
+        """Returns a lock to be held by whoever is fetching key, so that concurrent fetches aren't duplicated."""
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def refresh_in_background(self, key, refresh):
+        """Calls refresh() on a background thread, unless a background refresh of key is already under way."""
+        with self.lock:
+            if key in self.refreshing:
+                return None
+            self.refreshing[key] = thread = threading.Thread(target=self._run_refresh, args=(key, refresh),
+                                                             name="refresh %s" % key, daemon=True)
+            self.background_refreshes += 1
+        thread.start()
+        return thread
+
+    def _run_refresh(self, key, refresh):
+        try:
+            refresh()
+        finally:
+            with self.lock:
+                self.refreshing.pop(key, None)
+
+    def wait_for_refreshes(self, timeout=None):
+        """Waits for any background refreshes to finish. Mostly useful in testing."""
+        with self.lock:
+            threads = list(self.refreshing.values())
+        for thread in threads:
+            thread.join(timeout)
+
+    def is_usable(self, entry, now):
+        """Returns true if the entry is not too stale to serve."""
+        return entry is not None and now - entry.fetched_at <= self.max_staleness_seconds
+
+    def is_fresh(self, entry, now):
+        return self.is_usable(entry, now) and now - entry.checked_at < self.ttl_seconds
+
+    def store(self, key, data, now, **validators):
+        self.entries[key] = entry = CalendarCacheEntry(data, fetched_at=now, **validators)
+        return entry
+
+    def revalidated(self, entry, now):
+        """Notes that S3 told us the entry is unchanged, saving us a download and a parse."""
+        entry.fetched_at = entry.checked_at = now
+        self.not_modified += 1
+        self.bytes_saved += entry.size
+        self.parses_saved += 1
+        return entry
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "not_modified": self.not_modified,
+            "bytes_saved": self.bytes_saved,
+            "parses_saved": self.parses_saved,
+            "background_refreshes": self.background_refreshes,
+            "entries": len(self.entries),
+        }
+
+
+CALENDAR_CACHE = CalendarCache()
+
+
+def conditional_request_headers(entry):
+    """Returns the headers that ask S3 to send the calendar only if it differs from what's in the entry."""
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+    return headers
+
+
+# Connect and read timeouts for calendar fetches, so that a slow S3 can't eat up the whole lambda timeout.
+CALENDAR_FETCH_TIMEOUT = (_env_number("CALENDAR_CONNECT_TIMEOUT_SECONDS", 2),
+                          _env_number("CALENDAR_READ_TIMEOUT_SECONDS", 5))
+CALENDAR_FETCH_RETRIES = 2
+CALENDAR_FETCH_BACKOFF_FACTOR = 0.25
+CALENDAR_FETCH_RETRY_STATUSES = (500, 502, 503, 504)
+
+
+def make_calendar_session():
+    """
+    Creates a session for fetching calendars that keeps its connection to S3 alive between requests
+    and retries (with backoff) failed connections and server errors a bounded number of times.
+
+    A read that times out is not retried, since S3 was reached and is being slow, and neither is a
+    Retry-After header waited for, so that calendar_fetch_worst_case_seconds bounds how long a fetch can take.
+    """
+    retries = Retry(total=CALENDAR_FETCH_RETRIES, read=0, backoff_factor=CALENDAR_FETCH_BACKOFF_FACTOR,
+                    status_forcelist=CALENDAR_FETCH_RETRY_STATUSES, respect_retry_after_header=False)
+    # Both calendars live on the same host, but a local server wrapping lambda_handler may fetch concurrently.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retries)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def calendar_fetch_worst_case_seconds():
+    """
+    Returns the longest that fetching a calendar can take, backoff included, given that S3 answers promptly
+    with any error it's going to give. Only the last attempt can use up the read timeout, because a read timeout
+    is not retried, so each of the others can take no longer than the connect timeout.
+    """
+    connect_timeout, read_timeout = CALENDAR_FETCH_TIMEOUT
+    # There is no backoff before the first retry, and it doubles for each one after that.
+    backoff = sum(CALENDAR_FETCH_BACKOFF_FACTOR * 2 ** retry for retry in range(1, CALENDAR_FETCH_RETRIES))
+    return (CALENDAR_FETCH_RETRIES + 1) * connect_timeout + read_timeout + backoff
+
+
+_CALENDAR_SESSION = None
+
+
+def get_calendar_session():
+    """Returns the session used for calendar fetches, which persists across warm invocations."""
+    global _CALENDAR_SESSION
+    if _CALENDAR_SESSION is None:
+        _CALENDAR_SESSION = make_calendar_session()
+    return _CALENDAR_SESSION
+
+
+def set_calendar_session(session):
+    """
+    Replaces the session used for calendar fetches, returning the previous one.
+
+    This is mostly useful for testing, where a session can be given a stand-in transport
+    (with session.mount) so that no request actually goes to S3.
+    Passing None causes a fresh session to be made on next use.
+    """
+    global _CALENDAR_SESSION
+    old_session, _CALENDAR_SESSION = _CALENDAR_SESSION, session
+    return old_session
+
+
 def get_calendar_data(staged=False):
     url = CALENDAR_DATA_URL_STG if staged else CALENDAR_DATA_URL_PRD
 
-    try:
-        r = requests.get(url)
-        r.raise_for_status()
-        result = r.json()
-        return result or DEFAULT_DATA
-    except Exception as e:
-        data = {
-            "priority": CALENDAR_MISSING_PRIORITY,
-            "calendar": [],
-            "message": CALENDAR_MISSING_MESSAGE,
-            "problems": [{
-                "message": "%s: %s" % (full_class_name(e), e)
-            }],
-        }
-        return data
+    now = CALENDAR_CACHE.clock()
+    entry = CALENDAR_CACHE.entries.get(url)
+    if CALENDAR_CACHE.is_fresh(entry, now):
+        CALENDAR_CACHE.hits += 1
+        return entry.data
+    if CALENDAR_CACHE.stale_while_revalidate and CALENDAR_CACHE.is_usable(entry, now):
+        CALENDAR_CACHE.stale_hits += 1
+        CALENDAR_CACHE.refresh_in_background(url, lambda: refresh_calendar_data(url))
+        return entry.data
+    CALENDAR_CACHE.misses += 1
+    return refresh_calendar_data(url)
+
+
+def refresh_calendar_data(url):
+    """
+    Fetches the calendar at the given url into the calendar cache, returning the data that should be served.
+
+    Only one fetch of a given url happens at a time. A caller that has to wait for another's fetch
+    just uses its result.
+    """
+
+    with CALENDAR_CACHE.key_lock(url):
+
+        now = CALENDAR_CACHE.clock()
+        entry = CALENDAR_CACHE.entries.get(url)
+        if CALENDAR_CACHE.is_fresh(entry, now):
+            return entry.data
+
+        try:
+            # Even an entry too stale to serve on its own is fine to use if S3 says it hasn't changed.
+            r = get_calendar_session().get(url, headers=conditional_request_headers(entry),
+                                           timeout=CALENDAR_FETCH_TIMEOUT)
+            r.raise_for_status()
+            if r.status_code == 304 and entry is not None:
+                CALENDAR_CACHE.revalidated(entry, now)
+                print("Calendar at %s is unchanged, saving %d bytes and a parse (%d bytes and %d parses saved so far)."
+                      % (url, entry.size, CALENDAR_CACHE.bytes_saved, CALENDAR_CACHE.parses_saved))
+                return entry.data
+            result = r.json() or DEFAULT_DATA
+            # Compiling now means it's done once per fetch (and off the request path if refreshing in background).
+            # It's also done before the calendar is cached, so that one that can't be compiled doesn't replace
+            # the last good one.
+            compiled_calendar(result)
+            entry = CALENDAR_CACHE.store(url, result, now,
+                                         etag=r.headers.get('ETag'),
+                                         last_modified=r.headers.get('Last-Modified'),
+                                         size=len(r.content))
+            return entry.data
+        except Exception as e:
+            problem = "%s: %s" % (full_class_name(e), e)
+            if CALENDAR_CACHE.is_usable(entry, now):
+                # Keep showing the last good calendar rather than turning the banner red over a transient problem.
+                # We don't retry until the ttl has passed again, so an S3 outage doesn't slow every request.
+                print("Serving calendar from %s cached %.0f seconds ago after error. %s"
+                      % (url, now - entry.fetched_at, problem))
+                entry.checked_at = now
+                CALENDAR_CACHE.stale_hits += 1
+                return entry.data
+            data = {
+                "priority": CALENDAR_MISSING_PRIORITY,
+                "calendar": [],
+                "message": CALENDAR_MISSING_MESSAGE,
+                "problems": [{
+                    "message": problem
+                }],
+            }
+            return data
 
 
 CGAP_LOGO_URL = "https://cgap.hms.harvard.edu/static/img/exported-logo.svg"
 FF_LOGO_URL = "https://data.4dnucleome.org/static/img/4dn_logo.svg"
 
 
-def convert_to_html(data, environment):
-    if is_cgap_env(environment):
-        logo_url = CGAP_LOGO_URL
-        logo_url_alt = "CGAP helix logo"
-        page_name = "CGAP Status"
-    else:
-        logo_url = FF_LOGO_URL
-        logo_url_alt = "4DN sphere logo"
-        page_name = "Fourfront Status"
+class HtmlTemplate:
+    """
+    A template containing <<NAME>> slots, split just once into its static fragments and the names of its slots,
+    so that rendering it is a single join. (Unlike successive replacements, this never looks for slots in text
+    that has already been substituted.)
+    """
 
-    message = data.get("message")
-    calendar_events = data.get('calendar')
-    if not calendar_events and not message:
-        # When there's no error message to shown, supply a default event if nothing else to show.
-        calendar_events = [NULL_EVENT]
-    priority = data.get('priority') or DEFAULT_PRIORITY
-    event_str = io.StringIO()
-    sections_used = []
-    for i, event in enumerate(calendar_events, start=1):
-        # print("calendar_event=", calendar_event, "i=", i)
-        event_name = event.get('name') or "Event %s" % i
-        affects = event.get('affects') or {}
-        affects_name = affects.get('name') or ""
-        # affects_envs = affects.get('environments') or []
-        section = io.StringIO()
-        section.write('<dt class="calendar-event">%s</dt>\n' % html.escape(event_name))
-        section.write("<dd>\n")
-        section.write('<p><span class="who">%s</span>' % html.escape(affects_name))
-        section.write(' <span class="when">(%s to %s)</span></p>\n'
-                      % (html.escape(event.get('start_time') or "now"),
-                         html.escape(event.get('end_time') or "the foreseeable future")))
-        section.write('<p class="what">%s</p>\n' % (html.escape(event.get("description") or "To Be Determined")))
-        section.write("</dt>\n")
-        event_str.write(section.getvalue())
-        sections_used.append(i)
-    event_body = event_str.getvalue()
-    message = '<div class="message bgcolor_orange"><p>NOTE: ' + html.escape(message) + '</p></div>' if message else ''
-    substitutions = {
-        'PRIORITY': priority,
-        'LOGO_URL': logo_url,
-        'LOGO_URL_ALT': logo_url_alt,
-        'PAGE_NAME': page_name,
-        'EVENT_BODY': event_body,
-        'MESSAGE': message,
-    }
-    body = '''
+    SLOT_PATTERN = re.compile(r'<<([A-Z_]+)>>')
+
+    def __init__(self, text):
+        pieces = self.SLOT_PATTERN.split(text)
+        self.fragments = pieces[0::2]
+        self.slots = pieces[1::2]
+
+    def render(self, **values):
+        parts = [self.fragments[0]]
+        for slot, fragment in zip(self.slots, self.fragments[1:]):
+            parts.append(values[slot])
+            parts.append(fragment)
+        return ''.join(parts)
+
+
+STATUS_PAGE_TEMPLATE = HtmlTemplate('''
 <!DOCTYPE html>
 <html>
  <head>
@@ -169,61 +434,400 @@ def convert_to_html(data, environment):
    <<EVENT_BODY>>
   </dl>
  </body>
-</html>'''
-    for name, val in substitutions.items():
-        body = body.replace('<<' + name + '>>', val)
-    return body
+</html>''')
 
+EVENT_SECTION_FORMAT = ('<dt class="calendar-event">%s</dt>\n'
+                        '<dd>\n'
+                        '<p><span class="who">%s</span> <span class="when">(%s to %s)</span></p>\n'
+                        '<p class="what">%s</p>\n'
+                        '</dt>\n')
 
-def filter_data(data, environment, *, debug=False, now=None):
+
+def convert_to_html(data, environment):
+    if is_cgap_env(environment):
+        logo_url = CGAP_LOGO_URL
+        logo_url_alt = "CGAP helix logo"
+        page_name = "CGAP Status"
+    else:
+        logo_url = FF_LOGO_URL
+        logo_url_alt = "4DN sphere logo"
+        page_name = "Fourfront Status"
+
+    message = data.get("message")
+    calendar_events = data.get('calendar')
+    if not calendar_events and not message:
+        # When there's no error message to shown, supply a default event if nothing else to show.
+        calendar_events = [NULL_EVENT]
+    priority = data.get('priority') or DEFAULT_PRIORITY
+    sections = []
+    for i, event in enumerate(calendar_events, start=1):
+        event_name = event.get('name') or "Event %s" % i
+        affects = event.get('affects') or {}
+        affects_name = affects.get('name') or ""
+        sections.append(EVENT_SECTION_FORMAT % (html.escape(event_name),
+                                                html.escape(affects_name),
+                                                html.escape(event.get('start_time') or "now"),
+                                                html.escape(event.get('end_time') or "the foreseeable future"),
+                                                html.escape(event.get("description") or "To Be Determined")))
+    message = '<div class="message bgcolor_orange"><p>NOTE: ' + html.escape(message) + '</p></div>' if message else ''
+    return STATUS_PAGE_TEMPLATE.render(PRIORITY=priority,
+                                       LOGO_URL=logo_url,
+                                       LOGO_URL_ALT=logo_url_alt,
+                                       PAGE_NAME=page_name,
+                                       EVENT_BODY=''.join(sections),
+                                       MESSAGE=message)
+
+
+def as_epoch(timespec):
+    """Returns the POSIX timestamp for a datetime or <datetime-string> (in the reference timezone if none is given)."""
+    return as_ref_datetime(timespec).timestamp()
+
+
+def lead_time_seconds(lead_time):
+    if isinstance(lead_time, dict):
+        # "lead_time": {"hours": 1, "minutes": 30}
+        return as_seconds(**lead_time)
+    else:
+        # "lead_time": 5400
+        return lead_time
+
+
+class CompiledEvent:
+    """
+    A calendar event with its times parsed and its environments canonicalized, so that filtering it
+    needs only numeric comparisons.
+
+    The start is the effective start (i.e., with any lead time already subtracted), and both start and end
+    are POSIX timestamps, or None if unbounded. The environments are a frozenset of canonical environment names,
+    or None if all environments are affected. If the event could not be compiled, error is a description
+    of the problem, to be reported whenever the event would have been considered.
+    """
+
+    __slots__ = ('index', 'event', 'start', 'end', 'priority', 'environments', 'error')
+
+    def __init__(self, index, event, *, start=None, end=None, priority=None, environments=None, error=None):
+        self.index = index
+        self.event = event
+        self.start = start
+        self.end = end
+        self.priority = priority_value(None) if priority is None else priority
+        self.environments = environments
+        self.error = error
+
+    def affects(self, environment):
+        return self.environments is None or environment in self.environments
+
+    def is_active(self, when):
+        # Like in_datetime_interval, this is inclusive at both ends.
+        return (self.start is None or self.start <= when) and (self.end is None or when <= self.end)
+
+
+def compile_event(index, event):
+    compiled = CompiledEvent(index, event)
+    try:
+        affected_envs = (event.get('affects') or {}).get('environments')
+        if affected_envs is not None:
+            compiled.environments = frozenset(map(canonicalize_environment, affected_envs))
+        compiled.priority = priority_value(event.get("priority"))
+        start_time = event.get('start_time', None)
+        end_time = event.get('end_time', None)
+        if start_time:
+            start_time = as_ref_datetime(start_time)
+            lead_time = event.get('lead_time') or {}
+            if lead_time:
+                # This affects only the filtering, but not the display.
+                start_time -= datetime.timedelta(seconds=lead_time_seconds(lead_time))
+            compiled.start = start_time.timestamp()
+        if end_time:
+            compiled.end = as_epoch(end_time)
+    except Exception as e:
+        compiled.error = "%s: %s" % (full_class_name(e), e)
+    return compiled
+
+
+class IntervalIndex:
+    """
+    An index of compiled events that finds those active at a given time without looking at every event.
+
+    The events are sorted by effective start (unbounded starts first), so a binary search finds those that
+    have started. Over that order sits a segment tree holding the latest end within each range of events,
+    so that ranges in which everything has already ended are skipped. Finding the k active events among n
+    takes O(log n) steps per event found. Results are the same as CompiledEvent.is_active would give
+    (i.e., as in_datetime_interval would give), including for open-ended events.
+    """
+
+    def __init__(self, compiled_events):
+        self.events = sorted(compiled_events, key=lambda e: -math.inf if e.start is None else e.start)
+        self.starts = [-math.inf if e.start is None else e.start for e in self.events]
+        self.ends = sorted(e.end for e in self.events if e.end is not None)
+        self.leaves = size = 1 << max(0, len(self.events) - 1).bit_length()
+        latest_ends = [-math.inf] * (2 * size)
+        for i, event in enumerate(self.events):
+            latest_ends[size + i] = math.inf if event.end is None else event.end
+        for node in range(size - 1, 0, -1):
+            latest_ends[node] = max(latest_ends[2 * node], latest_ends[2 * node + 1])
+        self.latest_ends = latest_ends
+
+    def __len__(self):
+        return len(self.events)
+
+    def active_at(self, when):
+        """Returns the compiled events active at the given POSIX timestamp, in calendar order."""
+        return self._started_and_not_ended(bisect.bisect_right(self.starts, when), when)
+
+    def overlapping(self, start, end):
+        """Returns the compiled events active at any time from start to end (inclusive), in calendar order."""
+        return self._started_and_not_ended(bisect.bisect_right(self.starts, end), start)
+
+    def _started_and_not_ended(self, started, when):
+        """Returns those of the first started events (in start order) that end no earlier than when."""
+        latest_ends = self.latest_ends
+        result = []
+        pending = [(1, 0, self.leaves)]  # (node, first event covered, limit of events covered)
+        while pending:
+            node, lo, hi = pending.pop()
+            if lo >= started or latest_ends[node] < when:
+                continue
+            if hi - lo == 1:
+                result.append(self.events[lo])
+            else:
+                mid = (lo + hi) // 2
+                pending.append((2 * node + 1, mid, hi))
+                pending.append((2 * node, lo, mid))
+        result.sort(key=lambda e: e.index)
+        return result
+
+    def next_transition(self, when):
+        """
+        Returns the POSIX timestamp of the next time after the given one at which an event starts or ends,
+        or None if there is no such time. An event is still active at its end time, so it's at the end time
+        that the transition is reported, even though the event is only gone just after that.
+        """
+        transitions = []
+        i = bisect.bisect_right(self.starts, when)
+        if i < len(self.starts):
+            transitions.append(self.starts[i])
+        j = bisect.bisect_left(self.ends, when)
+        if j < len(self.ends):
+            transitions.append(self.ends[j])
+        return min(transitions) if transitions else None
+
+
+class CompiledCalendar:
+    """
+    The result of compiling calendar data. The data itself is kept, too, since the events are shown as given.
+
+    The events are also inverted by canonical environment, so that only the events naming a given environment
+    (plus those that affect all environments) need to be considered for it. Each environment named in the calendar
+    gets its own interval index of those candidates, built the first time it's needed. Any other environment
+    can only be affected by the events that affect all environments, which share a common index.
+    Events that failed to compile are not indexed, but are among the candidates so their problems can be reported.
+    """
+
+    __slots__ = ('data', 'version', 'events', 'by_environment', 'for_all_environments', 'common_index', 'indexes')
+
+    def __init__(self, data, events):
+        self.data = data
+        self.version = calendar_version(data)
+        self.events = events
+        self.by_environment = {}
+        self.for_all_environments = []
+        for event in events:
+            if event.environments is None:
+                self.for_all_environments.append(event)
+            else:
+                for environment in event.environments:
+                    self.by_environment.setdefault(environment, []).append(event)
+        self.common_index = IntervalIndex([event for event in self.for_all_environments if not event.error])
+        self.indexes = {}
+
+    def events_for(self, environment):
+        """Returns the events that affect the given (canonical) environment, in calendar order."""
+        specific_events = self.by_environment.get(environment)
+        if not specific_events:
+            return self.for_all_environments
+        return list(heapq.merge(specific_events, self.for_all_environments, key=lambda e: e.index))
+
+    def index_for(self, environment):
+        """Returns an interval index of the successfully compiled events that affect the given environment."""
+        if environment not in self.by_environment:
+            return self.common_index
+        index = self.indexes.get(environment)
+        if index is None:
+            self.indexes[environment] = index = IntervalIndex([event for event in self.events_for(environment)
+                                                               if not event.error])
+        return index
+
+
+def calendar_version(data):
+    """Returns a digest of calendar data that is the same wherever (and whenever) the same data is seen."""
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:20]
+
+
+# A calendar.json file can carry its own compiled events (see scripts/compile_calendar.py) under this key,
+# as a list with, for each calendar event in turn, [start, end, priority name, canonical environments or null],
+# along with a digest of the events they were compiled from.
+PRECOMPILED_KEY = "precompiled"
+PRECOMPILED_FORMAT = 1
+
+
+def precompiled_events(compiled_events):
+    """Returns the form in which the given (successfully) compiled events are stored in a calendar.json file."""
+    return {
+        "format": PRECOMPILED_FORMAT,
+        "digest": calendar_version([compiled_event.event for compiled_event in compiled_events]),
+        "events": [[compiled_event.start, compiled_event.end, ALL_PRIORITY_NAMES[compiled_event.priority],
+                    None if compiled_event.environments is None else sorted(compiled_event.environments)]
+                   for compiled_event in compiled_events],
+    }
+
+
+def _is_precompiled_time(value):
+    return value is None or (isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value))
+
+
+def is_precompiled_record(record):
+    """
+    Returns true if the record has the form of one made by precompiled_events.
+
+    The digest covers only the calendar events, not the records, so a record that was edited by hand
+    (or badly compiled) would otherwise be trusted, and a time given as a string, say, would break the
+    interval index for every request.
+    """
+    if not isinstance(record, list) or len(record) != 4:
+        return False
+    start, end, priority, environments = record
+    return (_is_precompiled_time(start) and _is_precompiled_time(end)
+            and isinstance(priority, str) and priority in ALL_PRIORITY_NAMES
+            and (environments is None
+                 or (isinstance(environments, list) and all(isinstance(env, str) for env in environments))))
+
+
+def load_precompiled_events(data):
+    """
+    Returns the compiled events stored in the given calendar data, or None if there are none that can be used
+    (in which case the calendar must be compiled as usual).
+    """
+    precompiled = data.get(PRECOMPILED_KEY)
     calendar_events = data.get("calendar") or []
-    priority = DEFAULT_PRIORITY
+    if not isinstance(precompiled, dict) or precompiled.get("format") != PRECOMPILED_FORMAT:
+        return None
+    records = precompiled.get("events")
+    if (not isinstance(records, list) or len(records) != len(calendar_events)
+            or precompiled.get("digest") != calendar_version(calendar_events)):
+        return None  # The calendar must have been edited since it was compiled.
+    if not all(is_precompiled_record(record) for record in records):
+        return None
+    return [CompiledEvent(i, event, start=start, end=end, priority=priority_value(priority),
+                          environments=None if environments is None else frozenset(environments))
+            for i, (event, (start, end, priority, environments)) in enumerate(zip(calendar_events, records))]
+
+
+def compile_calendar(data):
+    """
+    Compiles each event of the calendar data. Problems with an event are recorded with it, not raised.
+    If the data carries its own compiled events, those are used instead.
+    """
+    compiled_events = load_precompiled_events(data)
+    if compiled_events is None:
+        calendar_events = data.get("calendar") or []
+        compiled_events = [compile_event(i, event) for i, event in enumerate(calendar_events)]
+    return CompiledCalendar(data, compiled_events)
+
+
+# Keyed by the id of the data compiled. Each CompiledCalendar holds onto its data, so the id can't be reused.
+_COMPILED_CALENDARS = collections.OrderedDict()
+_COMPILED_CALENDARS_LOCK = threading.Lock()
+COMPILED_CALENDARS_MAX = 8
+
+
+def compiled_calendar(data):
+    """Returns the compiled form of the given calendar data, compiling it only if it hasn't been seen recently."""
+    with _COMPILED_CALENDARS_LOCK:
+        compiled = _COMPILED_CALENDARS.get(id(data))
+        if compiled is not None and compiled.data is data:
+            _COMPILED_CALENDARS.move_to_end(id(data))
+            return compiled
+    compiled = compile_calendar(data)
+    with _COMPILED_CALENDARS_LOCK:
+        _COMPILED_CALENDARS[id(data)] = compiled
+        while len(_COMPILED_CALENDARS) > COMPILED_CALENDARS_MAX:
+            _COMPILED_CALENDARS.popitem(last=False)
+    return compiled
+
+
+def clear_compiled_calendars():
+    """Forgets every compiled calendar, so that each calendar is compiled again the next time it's needed."""
+    with _COMPILED_CALENDARS_LOCK:
+        _COMPILED_CALENDARS.clear()
+
+
+def filter_time(now=None):
+    """Given the (optional) now= parameter for filtering, returns the time to filter at and its POSIX timestamp."""
+    filter_now = as_datetime(now, raise_error=False) or ref_now()
+    return filter_now, as_epoch(filter_now)
+
+
+# The most that any response can be cached for. Even when no event is due to start or end for a long time,
+# the calendar itself might be edited.
+CACHE_CONTROL_MAX_AGE_SECONDS = _env_number("CACHE_CONTROL_MAX_AGE_SECONDS", 900)
+
+
+def cache_control_max_age(data, environment, *, now=None):
+    """
+    Returns how many seconds a response about the given environment can be cached for: until the next time
+    one of its events comes into its window (taking lead time into account) or leaves it,
+    but no longer than CACHE_CONTROL_MAX_AGE_SECONDS.
+    """
+    if data.get("message"):
+        # The calendar couldn't be had. It's worth asking again as soon as we'll try to fetch it again.
+        return int(min(CACHE_CONTROL_MAX_AGE_SECONDS, CALENDAR_CACHE.ttl_seconds))
+    _, when = filter_time(now)
+    transition = compiled_calendar(data).index_for(environment).next_transition(when)
+    if transition is None or transition - when >= CACHE_CONTROL_MAX_AGE_SECONDS:
+        return int(CACHE_CONTROL_MAX_AGE_SECONDS)
+    return max(0, math.floor(transition - when))
+
+
+def active_events(calendar, environment, when):
+    """
+    Returns the priority value for the given environment at the given POSIX time
+    and the events (as given in the calendar) in effect for it then.
+    """
+    priority = priority_value(DEFAULT_PRIORITY)
+    events = []
+    for compiled_event in calendar.index_for(environment).active_at(when):
+        events.append(compiled_event.event)
+        priority = max(priority, compiled_event.priority)
+    return priority, events
+
+
+def filter_data(data, environment, *, debug=False, now=None):
+    calendar = compiled_calendar(data)
     # "message" and "problems" are not intended to be used in ordinary calendar.json file.
     # Instead they're used for error handling if the calendar is not available
     # and must be propagated so the end user will understand why data was unavailable.
     message = data.get("message")
-    problems = data.get("problems", [])
-    filtered_calendar_events = []
-    filter_now = as_datetime(now, raise_error=False) or ref_now()
-    seen = []
-    removed = []
-    for event in calendar_events:
-        try:
-            seen.append(event)
-            start_time = event.get('start_time', None)
-            end_time = event.get('end_time', None)
-            affected_envs = (event.get('affects') or {}).get('environments')
-            if affected_envs is None or environment in map(canonicalize_environment, affected_envs):
-                if start_time:
-                    start_time = as_ref_datetime(start_time)
-                    lead_time = event.get('lead_time') or {}
-                    if lead_time:
-                        if isinstance(lead_time, dict):
-                            # "lead_time": {"hours": 1, "minutes": 30}
-                            lead_seconds = as_seconds(**lead_time)
-                        else:
-                            # "lead_time": 5400
-                            lead_seconds = lead_time
-                        # This operation affects only the filtering, but not the display.
-                        start_time -= datetime.timedelta(seconds=lead_seconds)
-                if in_datetime_interval(filter_now, start=start_time, end=end_time):
-                    filtered_calendar_events.append(event)
-                    priority = merge_priorities(priority, event.get("priority"))
-                else:
-                    removed.append(event)
-        except Exception as e:
+    # The data may be shared with the calendar cache, so we must not modify the list of problems it holds.
+    problems = list(data.get("problems", []))
+    filter_now, when = filter_time(now)
+    candidates = calendar.events_for(environment)
+    for compiled_event in candidates:
+        if compiled_event.error:
             problems.append({
-                "event": event,
-                "message": "%s: %s" % (full_class_name(e), e),
+                "event": compiled_event.event,
+                "message": compiled_event.error,
             })
+    priority, filtered_calendar_events = active_events(calendar, environment, when)
     result = {}
     if debug:
         result["now"] = now
         result["filter_now"] = str(filter_now)
-        result["seen"] = seen
+        result["seen"] = [compiled_event.event for compiled_event in calendar.events]
         result["defaulted"] = False
-        result["removed"] = removed
-    result["priority"] = priority
+        result["removed"] = [compiled_event.event for compiled_event in candidates
+                             if not compiled_event.error and not compiled_event.is_active(when)]
+    result["priority"] = ALL_PRIORITY_NAMES[priority]
     if message:
         result["message"] = message
     result["calendar"] = filtered_calendar_events
@@ -232,6 +836,363 @@ def filter_data(data, environment, *, debug=False, now=None):
     return result
 
 
+# An event is active through its end time, so it's a moment later that it's gone.
+END_RESOLUTION_SECONDS = 1e-6
+
+
+def timeline(calendar, environment, start, end):
+    """
+    Given a compiled calendar, an environment and the POSIX timestamps of the start and end of a time range,
+    returns a list of (from, until, priority value, compiled events) tuples, one for each stretch of time
+    during which the same events are active, in time order. Each stretch runs from its from time up to
+    (but not including) its until time, except that the last one includes the end of the range.
+
+    The events overlapping the range are found in the environment's interval index, and their starts and ends
+    are swept through in order, so this takes O(n log n) steps for n such events.
+    """
+    changes = []
+    active = {}
+    for compiled_event in calendar.index_for(environment).overlapping(start, end):
+        if compiled_event.start is not None and compiled_event.end is not None \
+                and compiled_event.end < compiled_event.start:
+            continue  # It's never active.
+        if compiled_event.start is None or compiled_event.start <= start:
+            active[compiled_event.index] = compiled_event
+        else:
+            changes.append((compiled_event.start, True, compiled_event))
+        if compiled_event.end is not None and compiled_event.end + END_RESOLUTION_SECONDS <= end:
+            changes.append((compiled_event.end + END_RESOLUTION_SECONDS, False, compiled_event))
+    changes.sort(key=lambda change: change[0])
+    # How many active events have each priority, so the highest can be found without looking at them all.
+    priority_counts = [0] * len(ALL_PRIORITY_NAMES)
+    for compiled_event in active.values():
+        priority_counts[compiled_event.priority] += 1
+    default_priority = priority_value(DEFAULT_PRIORITY)
+
+    def current_priority():
+        for priority in range(len(priority_counts) - 1, default_priority, -1):
+            if priority_counts[priority]:
+                return priority
+        return default_priority
+
+    result = []
+    segment_start = start
+    i = 0
+    while True:
+        change_time = changes[i][0] if i < len(changes) else None
+        if change_time is None or change_time > segment_start:
+            result.append((segment_start, end if change_time is None else change_time, current_priority(),
+                           sorted(active.values(), key=lambda e: e.index)))
+            if change_time is None:
+                return result
+            segment_start = change_time
+        while i < len(changes) and changes[i][0] == change_time:
+            _, starting, compiled_event = changes[i]
+            if starting:
+                active[compiled_event.index] = compiled_event
+                priority_counts[compiled_event.priority] += 1
+            else:
+                del active[compiled_event.index]
+                priority_counts[compiled_event.priority] -= 1
+            i += 1
+
+
+# Made at load time, so that it stays a real datetime even where tests replace datetime.datetime.
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def as_ref_time(timestamp):
+    """Returns the datetime in the reference timezone for a POSIX timestamp."""
+    return (_EPOCH + datetime.timedelta(seconds=timestamp)).astimezone(REF_TZ)
+
+
+def filter_timeline(data, environment, start=None, end=None, *, now=None):
+    """
+    Like filter_data, but describes each stretch of time between the given start and end (<datetime-string>s)
+    during which the same events are in effect for the environment, rather than the events in effect at one time.
+    If no start is given, the timeline starts at the time that filter_data would use.
+    """
+    if not end:
+        raise ValueError("The end of the timeline (to=) must be given.")
+    calendar = compiled_calendar(data)
+    message = data.get("message")
+    problems = list(data.get("problems", []))
+    for compiled_event in calendar.events_for(environment):
+        if compiled_event.error:
+            problems.append({
+                "event": compiled_event.event,
+                "message": compiled_event.error,
+            })
+    start = filter_time(now)[1] if start is None else as_epoch(start)
+    end = as_epoch(end)
+    if end < start:
+        raise ValueError("The timeline must not end (to=) before it starts (from=).")
+    segments = []
+    for segment_start, segment_end, priority, compiled_events in timeline(calendar, environment, start, end):
+        segments.append({
+            "from": str(as_ref_time(segment_start)),
+            "until": str(as_ref_time(segment_end)),
+            "priority": ALL_PRIORITY_NAMES[priority],
+            "calendar": [compiled_event.event for compiled_event in compiled_events],
+        })
+    result = {
+        "priority": merge_priorities(DEFAULT_PRIORITY, *[segment["priority"] for segment in segments]),
+        "from": str(as_ref_time(start)),
+        "to": str(as_ref_time(end)),
+    }
+    if message:
+        result["message"] = message
+    result["timeline"] = segments
+    if problems:
+        result["problems"] = problems
+    return result
+
+
+# Environment names in a batch request are chosen by whoever calls us, so there must be some limit on them.
+MAX_BATCH_ENVIRONMENTS = 50
+
+
+def known_environments(data):
+    """
+    Returns the canonical names of the production and test environments of both Fourfront and CGAP,
+    followed by any other environments the calendar names, without duplicates.
+    """
+    # These are imported here, so that a dcicutils without them breaks only requests for all environments.
+    try:
+        from dcicutils.env_utils import FF_PROD_BUCKET_ENV, CGAP_PROD_BUCKET_ENV, BEANSTALK_TEST_ENVS
+    except ImportError:  # Newer versions of dcicutils have them only in env_utils_legacy, which older ones lack.
+        from dcicutils.env_utils_legacy import FF_PROD_BUCKET_ENV, CGAP_PROD_BUCKET_ENV, BEANSTALK_TEST_ENVS
+    environments = [FF_PROD_BUCKET_ENV, CGAP_PROD_BUCKET_ENV] + list(BEANSTALK_TEST_ENVS)
+    environments = [canonicalize_environment(environment) for environment in environments]
+    environments.extend(sorted(compiled_calendar(data).by_environment))
+    return list(dict.fromkeys(environments))
+
+
+def batch_environments(data, environments=None, environment=None):
+    """
+    Given the environments= and environment= parameters of a request, returns None unless a batch of environments
+    is asked for. Otherwise, returns a dictionary mapping each environment name requested
+    (or, for environment=*, each known environment) to the canonical environment it refers to.
+    """
+    if environment == "*":
+        names = known_environments(data)
+    elif environments:
+        names = [name.strip() for name in environments.split(",") if name.strip()]
+        if len(names) > MAX_BATCH_ENVIRONMENTS:
+            raise ValueError("At most %s environments can be requested at once." % MAX_BATCH_ENVIRONMENTS)
+    else:
+        return None
+    return {name: canonicalize_environment(name) for name in names}
+
+
+def filter_environments(data, environments, *, now=None):
+    """
+    Like filter_data, but for each of several environments (as returned by batch_environments) at once.
+    The calendar is compiled once, and each environment's events are found in the index for it.
+    The overall priority is the highest of any environment's.
+    """
+    calendar = compiled_calendar(data)
+    message = data.get("message")
+    problems = list(data.get("problems", []))
+    _, when = filter_time(now)
+    results = {}
+    failed_events = {}
+    for name, environment in environments.items():
+        for compiled_event in calendar.events_for(environment):
+            if compiled_event.error:
+                failed_events[compiled_event.index] = compiled_event
+        priority, events = active_events(calendar, environment, when)
+        results[name] = {"priority": ALL_PRIORITY_NAMES[priority], "calendar": events}
+    for index in sorted(failed_events):
+        problems.append({
+            "event": failed_events[index].event,
+            "message": failed_events[index].error,
+        })
+    result = {"priority": merge_priorities(DEFAULT_PRIORITY, *[result["priority"] for result in results.values()])}
+    if message:
+        result["message"] = message
+    result["environments"] = results
+    if problems:
+        result["problems"] = problems
+    return result
+
+
+class ResponseCache:
+    """
+    A bounded, least-recently-used cache of rendered responses.
+
+    Between calendar transitions, the response for a given environment and format doesn't change, so it's keyed
+    by the calendar version, the environment, the format and the events active (see response_cache_key).
+    """
+
+    def __init__(self, *, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "size": len(self.entries),
+            "max_size": self.max_entries,
+        }
+
+
+RESPONSE_CACHE = ResponseCache(max_entries=int(_env_number("RESPONSE_CACHE_SIZE", 64)))
+
+
+def response_cache_key(data, environment, response_format, *, pretty=False, now=None):
+    """Returns a key that is the same for any two requests that would get the same response body."""
+    calendar = compiled_calendar(data)
+    _, when = filter_time(now)
+    active = tuple(compiled_event.index for compiled_event in calendar.index_for(environment).active_at(when))
+    return calendar.version, environment, response_format, pretty, active
+
+
+def batch_cache_key(data, environments, *, pretty=False, now=None):
+    """Like response_cache_key, but for a batch of environments (as returned by batch_environments)."""
+    calendar = compiled_calendar(data)
+    _, when = filter_time(now)
+    active = tuple(tuple(compiled_event.index for compiled_event in calendar.index_for(environment).active_at(when))
+                   for environment in environments.values())
+    return calendar.version, tuple(environments.items()), 'batch', pretty, active
+
+
+# This must be changed whenever a change to the code changes how a response is rendered (such as the page template
+# or the layout of the JSON), so that tags given out by an earlier deployment no longer match.
+RESPONSE_FORMAT_VERSION = 1
+
+
+def response_etag(cache_key, encoding=None):
+    """
+    Returns a strong entity tag for the response with the given response_cache_key and content encoding.
+    Since the key and encoding (along with RESPONSE_FORMAT_VERSION) determine the body exactly, so does the tag.
+    """
+    cache_key = (RESPONSE_FORMAT_VERSION,) + cache_key
+    if encoding:
+        cache_key = cache_key + (encoding,)
+    return '"%s"' % hashlib.sha1(repr(cache_key).encode('utf-8')).hexdigest()
+
+
+def etag_matches(if_none_match, etag):
+    """Returns true if an If-None-Match header value matches the given entity tag."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        # If-None-Match uses the weak comparison, which ignores any W/ prefix.
+        if candidate == "*" or remove_prefix("W/", candidate) == etag:
+            return True
+    return False
+
+
+def dump_json(data, *, pretty=False):
+    """
+    Returns the name of the encoder used and the JSON text for the given data,
+    indented if pretty is true and otherwise as compact as possible.
+    """
+    if orjson:
+        try:
+            return 'orjson', orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0).decode('utf-8')
+        except TypeError:
+            pass  # orjson is stricter than json (e.g., about very large integers), so let json have a try.
+    if pretty:
+        return 'json', json.dumps(data, indent=2)
+    else:
+        return 'json', json.dumps(data, separators=(',', ':'))
+
+
+def render_body(data, environment, response_format, *, pretty=False):
+    """
+    Given filtered data, returns the headers describing a response in the given format and its body.
+    Only JSON responses can be pretty printed.
+    """
+    if response_format == 'json':
+        encoder, body = dump_json(data, pretty=pretty)
+        return {"Content-Type": "application/json", "X-JSON-Encoder": encoder}, body
+    else:
+        return {"Content-Type": 'text/html'}, convert_to_html(data or [], environment)
+
+
+def gzip_compress(body):
+    """
+    Returns the given bytes compressed with gzip. The mtime of 0 keeps the output the same from one compression
+    to the next, as a strong ETag requires. (gzip.compress only takes an mtime in Python 3.8 and later.)
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6, mtime=0) as fp:
+        fp.write(body)
+    return buffer.getvalue()
+
+
+CONTENT_ENCODERS = {
+    'gzip': gzip_compress,
+}
+
+if brotli:
+    CONTENT_ENCODERS['br'] = lambda body: brotli.compress(body, mode=brotli.MODE_TEXT)
+
+# Most preferred first, for when a client accepts several encodings equally.
+CONTENT_ENCODING_PREFERENCE = ['br', 'gzip']
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Given an Accept-Encoding header value, returns the name of the content encoding to use,
+    or None if the body should be sent as is.
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, *parameters = [part.strip() for part in item.split(";")]
+        weight = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.lower()] = weight
+    best, best_weight = None, 0.0
+    for coding in CONTENT_ENCODING_PREFERENCE:
+        weight = weights.get(coding, weights.get('*', 0.0))
+        if coding in CONTENT_ENCODERS and weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def encode_body(body, encoding):
+    """Returns the given body compressed with the given content encoding, as base64 text."""
+    return base64.b64encode(CONTENT_ENCODERS[encoding](body.encode('utf-8'))).decode('ascii')
+
+
 CORS_HEADERS = {
     # It may be that only GET is needed, but just in case. -kmp&akb 20-Mar-2020
     "Access-Control-Allow-Methods": "GET,HEAD,OPTIONS",
@@ -249,11 +1210,29 @@ CORS_HEADERS = {
 }
 
 
+# Referers, hosts and environment names are chosen by whoever calls us, so the memos for them must be bounded.
+ENVIRONMENT_MEMO_SIZE = int(_env_number("ENVIRONMENT_MEMO_SIZE", 256))
+
+
+@functools.lru_cache(maxsize=ENVIRONMENT_MEMO_SIZE)
 def canonicalize_environment(environment):
     # We implement canonical naming of these environments by using the bucket environment.
     return get_bucket_env(environment)
 
 
+def _server_url_key(url):
+    """
+    Reduces a server url to the only part of it that matters to classify_server_url, its hostname,
+    so that requests from different pages on the same server share a memo entry.
+    """
+    try:
+        hostname = urlparse(url).hostname
+    except ValueError:
+        hostname = None
+    # If there's no hostname, classify_server_url will complain about the url just as it would have before.
+    return "https://%s/" % hostname if hostname else url
+
+
 def resolve_environment(host, referer, application, environment):
     """
     Given referer, application, and environment supplied with a request, figure out what environment to use.
@@ -262,6 +1241,8 @@ def resolve_environment(host, referer, application, environment):
     This function is intended to just pick the best value without complaining
     There is no value to an error message.
 
+    Results are memoized (see environment_memo_stats), since the set of values we're asked about is small.
+
     :param referer: a string (referer URL) or None
     :param application: a string (either 'cgap' or 'fourfront') or None
     :param environment: an environment (e.g., 'fourfront-mastertest') or None
@@ -269,13 +1250,20 @@ def resolve_environment(host, referer, application, environment):
     """
     if environment:
         return canonicalize_environment(environment)
+    return _resolve_server_environment(host=host if host and host.startswith("status.") else None,
+                                       referer=_server_url_key(referer) if referer else None,
+                                       application=application)
+
+
+@functools.lru_cache(maxsize=ENVIRONMENT_MEMO_SIZE)
+def _resolve_server_environment(host, referer, application):
     if referer:
         classification = classify_server_url(referer, raise_error=False)
         if classification['kind'] in ('fourfront', 'cgap'):
             env = classification['environment']
             env = env.strip('-0123456789')
             return env
-    if host and host.startswith("status."):
+    if host:
         host_url = 'https://' + remove_prefix("status.", host)
         classification = classify_server_url(host_url, raise_error=False)
         if classification['kind'] in ('fourfront', 'cgap'):
@@ -285,12 +1273,154 @@ def resolve_environment(host, referer, application, environment):
     return prod_bucket_env_for_app(application)
 
 
-def lambda_handler(event, context):
+def environment_memo_stats():
+    """Returns the hits, misses and sizes of the memos used by resolve_environment."""
+    result = {}
+    for name, memo in (("canonicalize_environment", canonicalize_environment),
+                       ("resolve_environment", _resolve_server_environment)):
+        info = memo.cache_info()
+        lookups = info.hits + info.misses
+        result[name] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": info.hits / lookups if lookups else None,
+            "size": info.currsize,
+            "max_size": info.maxsize,
+        }
+    return result
+
+
+def clear_environment_memos():
+    canonicalize_environment.cache_clear()
+    _resolve_server_environment.cache_clear()
+
+
+# Whether responses say how long each stage of handling them took, in a Server-Timing header.
+SERVER_TIMING = _env_flag("SERVER_TIMING")
+# Whether each invocation writes its timings and counts to stdout in CloudWatch Embedded Metric Format.
+METRICS_LOG = _env_flag("METRICS_LOG")
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "4dn-status")
+
+
+class _StageTimer:
+
+    __slots__ = ('durations', 'name', 'started')
+
+    def __init__(self, durations, name):
+        self.durations = durations
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.durations[self.name] = self.durations.get(self.name, 0) + time.perf_counter() - self.started
+
+
+class RequestMetrics:
+    """
+    Records how long each stage of handling a request took, and some counts and properties of the request
+    (such as whether the calendar or the response came from a cache), for the Server-Timing header and
+    the metrics log.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = {}  # stage name -> seconds, in the order the stages were first timed
+        self.counts = {}
+        self.properties = {}
+
+    def stage(self, name):
+        """Returns a context manager that adds the time spent inside it to the named stage."""
+        return _StageTimer(self.durations, name)
+
+    def count(self, name, value):
+        self.counts[name] = value
+
+    def note(self, name, value):
+        self.properties[name] = value
+
+    def finish(self):
+        self.durations["total"] = time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Returns the value of a Server-Timing header describing the durations (in milliseconds) and counts."""
+        return ", ".join(["%s;dur=%.3f" % (name, seconds * 1000) for name, seconds in self.durations.items()]
+                         + ["%s;desc=%s" % (name, value) for name, value in self.counts.items()])
+
+    def emf_record(self, endpoint):
+        """Returns a log record in CloudWatch Embedded Metric Format, with the endpoint as its dimension."""
+        metrics = ([{"Name": name + "_ms", "Unit": "Milliseconds"} for name in self.durations]
+                   + [{"Name": name, "Unit": "Count"} for name in self.counts])
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Endpoint"]],
+                    "Metrics": metrics,
+                }],
+            },
+            "Endpoint": endpoint,
+        }
+        record.update(self.properties)
+        record.update((name + "_ms", round(seconds * 1000, 3)) for name, seconds in self.durations.items())
+        record.update(self.counts)
+        return record
+
+
+class _NoStageTimer:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _NoMetrics:
+    """Stands in for RequestMetrics when neither the Server-Timing header nor the metrics log is wanted."""
+
+    _NO_STAGE = _NoStageTimer()
+
+    def stage(self, name):
+        return self._NO_STAGE
+
+    def count(self, name, value):
+        pass
+
+    def note(self, name, value):
+        pass
+
+
+NO_METRICS = _NoMetrics()
+
+
+def report_metrics(metrics, result, *, endpoint):
+    """Adds a Server-Timing header to the result and/or logs the metrics, according to the configuration."""
+    metrics.finish()
+    if SERVER_TIMING and "headers" in result:
+        result["headers"]["Server-Timing"] = metrics.server_timing()
+    if METRICS_LOG:
+        print(json.dumps(metrics.emf_record(endpoint)), flush=True)
+
+
+def handle_request(event, context):
     ignored(context)  # This will be ignored unless the commented-out block below is uncommented.
 
     staged = event.get("rawPath", PRD_ENDPOINT_PATH) == STG_ENDPOINT_PATH
+    metrics = RequestMetrics() if SERVER_TIMING or METRICS_LOG else NO_METRICS
 
-    data = get_calendar_data(staged=staged)
+    calendar_cache_hits = CALENDAR_CACHE.hits + CALENDAR_CACHE.stale_hits
+    bytes_saved, parses_saved = CALENDAR_CACHE.bytes_saved, CALENDAR_CACHE.parses_saved
+    with metrics.stage("fetch"):
+        data = get_calendar_data(staged=staged)
+    metrics.count("calendar_cache_hit", int(CALENDAR_CACHE.hits + CALENDAR_CACHE.stale_hits > calendar_cache_hits))
+    # What a conditional fetch saved (if this request made one), so the savings can be summed across invocations.
+    metrics.count("calendar_bytes_saved", CALENDAR_CACHE.bytes_saved - bytes_saved)
+    metrics.count("calendar_parses_saved", CALENDAR_CACHE.parses_saved - parses_saved)
     params = event.get("queryStringParameters") or {}
 
     # It might be a security problem to leave this turned on in production, but it may be useful to enable
@@ -319,36 +1449,185 @@ def lambda_handler(event, context):
         now = params.get("now", None)
         debug = params.get("debug", "FALSE").upper() == "TRUE"
         application = params.get("application")
-        host = event.get('headers', {}).get('host')
-        referer = event.get('headers', {}).get('referer')
-        environment = params.get("environment")
-        environment = resolve_environment(host=host, referer=referer, application=application, environment=environment)
-        data = filter_data(data, environment, debug=debug, now=now)
-        response_format = params.get("format") or "html"
-        if response_format == 'json':
+        headers = event.get('headers') or {}
+        host = headers.get('host')
+        referer = headers.get('referer')
+        with metrics.stage("compile"):
+            metrics.count("calendar_events", len(compiled_calendar(data).events))
+        with metrics.stage("resolve"):
+            environment = params.get("environment")
+            environments = batch_environments(data, environments=params.get("environments"),
+                                              environment=environment)
+            timeline_range = None
+            if environments is None:
+                environment = resolve_environment(host=host, referer=referer, application=application,
+                                                  environment=environment)
+                max_age = cache_control_max_age(data, environment, now=now)
+                if "from" in params or "to" in params:
+                    timeline_range = params.get("from"), params.get("to")
+                    response_format = 'json'
+                else:
+                    response_format = 'json' if params.get("format") == 'json' else 'html'
+            else:
+                # A batch response is good only for as long as its response about each environment would be.
+                max_age = min([cache_control_max_age(data, environment, now=now)
+                               for environment in set(environments.values())],
+                              default=int(CACHE_CONTROL_MAX_AGE_SECONDS))
+                response_format = 'json'
+        metrics.note("environment", environment if environments is None else sorted(environments))
+        metrics.note("format", 'timeline' if timeline_range else response_format)
+        # A response for some other time must not be served by a shared cache to someone asking about the present.
+        cache_control = "no-store" if now else "public, max-age=%d" % max_age
+        # JSON is compact unless asked otherwise, but debugging output is meant to be read by people.
+        pretty = (response_format == 'json'
+                  and params.get("pretty", "TRUE" if debug else "FALSE").upper() == "TRUE")
+        # Overriding the time or asking for debugging information makes a response that's not worth caching.
+        # A profiled response isn't cached either, so that the profile shows the work of making it.
+        # Nor is a response saying the calendar is unavailable, since each distinct failure would have its own
+        # calendar version, and so its own entries, pushing good responses out of the cache.
+        if debug or now or wants_profile(params) or data.get("message"):
+            cache_key = None
+        elif timeline_range:
+            # A timeline with a given start doesn't depend on the time it's asked for.
+            cache_key = timeline_range[0] and (compiled_calendar(data).version, environment, 'timeline', pretty,
+                                               timeline_range)
+        elif environments is None:
+            cache_key = response_cache_key(data, environment, response_format, pretty=pretty)
+        else:
+            cache_key = batch_cache_key(data, environments, pretty=pretty)
+        encoding = negotiate_encoding(headers.get('accept-encoding'))
+        etag = cache_key and response_etag(cache_key, encoding)
+        if etag and etag_matches(headers.get('if-none-match'), etag):
+            # The client already has this response, so there's no need to render or send it.
+            metrics.count("not_modified", 1)
             result = {
-                "statusCode": 200,
+                "statusCode": 304,
                 "headers": {
-                    "Content-Type": "application/json",
-                    "Cache-Control": "public, max-age=120",
+                    "ETag": etag,
+                    "Cache-Control": cache_control,
+                    "Vary": "Accept-Encoding",
                 },
-                "body": json.dumps(data, indent=2),
+                "body": "",
             }
         else:
+            metrics.count("not_modified", 0)
+            metrics.count("response_cache_hit", 1)  # unless it turns out to need rendering
+            # Compressed variants are cached next to the uncompressed response they were made from.
+            encoded_key = cache_key and encoding and cache_key + (encoding,)
+            rendered = cache_key and RESPONSE_CACHE.get(encoded_key or cache_key)
+            if not rendered:
+                rendered = cache_key and encoded_key and RESPONSE_CACHE.get(cache_key)
+                if not rendered:
+                    metrics.count("response_cache_hit", 0)
+                    with metrics.stage("filter"):
+                        if environments is not None:
+                            data = filter_environments(data, environments, now=now)
+                        elif timeline_range:
+                            data = filter_timeline(data, environment, *timeline_range, now=now)
+                        else:
+                            data = filter_data(data, environment, debug=debug, now=now)
+                            metrics.count("active_events", len(data["calendar"]))
+                    with metrics.stage("render"):
+                        rendered = render_body(data, environment, response_format, pretty=pretty)
+                    if cache_key:
+                        RESPONSE_CACHE.put(cache_key, rendered)
+                if encoding:
+                    body_headers, body = rendered
+                    with metrics.stage("encode"):
+                        rendered = body_headers, encode_body(body, encoding)
+                    if encoded_key:
+                        RESPONSE_CACHE.put(encoded_key, rendered)
+            body_headers, body = rendered
             result = {
                 "statusCode": 200,
-                "headers": {
-                    "Content-Type": 'text/html',
-                    "Cache-Control": "public, max-age=120",
-                },
-                "body": convert_to_html(data or [], environment)
+                "headers": dict(body_headers, **{
+                    "Cache-Control": cache_control,
+                    "Vary": "Accept-Encoding",
+                }),
+                "body": body,
             }
+            if encoding:
+                result["headers"]["Content-Encoding"] = encoding
+                result["isBase64Encoded"] = True
+            if etag:
+                result["headers"]["ETag"] = etag
         result = dict(result, **CORS_HEADERS)
-        return result
 
     except Exception as e:
 
-        return {"message": "%s: %s" % (full_class_name(e), e)}
+        metrics.count("errors", 1)
+        result = {"message": "%s: %s" % (full_class_name(e), e)}
+
+    if metrics is not NO_METRICS:
+        report_metrics(metrics, result, endpoint=STG_ENDPOINT_PATH if staged else PRD_ENDPOINT_PATH)
+    return result
+
+
+# Whether profile=true can be used to profile a request. This must never be turned on for a public endpoint.
+PROFILING = _env_flag("PROFILING")
+# How many functions (those with the most cumulative time) a profile lists.
+PROFILE_TOP_N = int(_env_number("PROFILE_TOP_N", 25))
+
+
+def wants_profile(params):
+    return PROFILING and params.get("profile", "FALSE").upper() == "TRUE"
+
+
+def profile_entries(stats, *, top):
+    """Given a pstats.Stats, returns descriptions of the top functions by cumulative time, most first."""
+    entries = []
+    for (filename, line, function), (primitive_calls, calls, own_time, cumulative_time, _) in stats.stats.items():
+        # Only the package and module of a file are needed to tell where a function is.
+        where = "/".join(filename.replace(os.sep, "/").split("/")[-2:])
+        entries.append({
+            "function": "%s:%s(%s)" % (where, line, function) if line else function,
+            "calls": calls,
+            "primitive_calls": primitive_calls,
+            "own_seconds": own_time,
+            "cumulative_seconds": cumulative_time,
+        })
+    entries.sort(key=lambda entry: entry["cumulative_seconds"], reverse=True)
+    return entries[:top]
+
+
+def profiled_request(event, context):
+    """
+    Handles the request under cProfile, logging the top PROFILE_TOP_N functions by cumulative time and
+    returning them (as JSON) in place of the usual response, along with the status code it would have had.
+
+    In a warm container, the calendar would already be compiled and the environments resolved, hiding the costs
+    that a troublesome calendar would show, so those are forgotten first and the profile shows them being redone.
+    """
+    import cProfile  # These are imported only when needed, to keep cold starts quick.
+    import pstats
+    clear_compiled_calendars()
+    clear_environment_memos()
+    profiler = cProfile.Profile()
+    result = profiler.runcall(handle_request, event, context)
+    stats = pstats.Stats(profiler)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_N)  # This goes to the log.
+    report = {
+        "statusCode": result.get("statusCode"),
+        "total_calls": stats.total_calls,
+        "total_seconds": stats.total_tt,
+        "profile": profile_entries(stats, top=PROFILE_TOP_N),
+    }
+    if "statusCode" not in result:
+        report["message"] = result.get("message")
+    return dict({
+        "statusCode": 200,
+        "headers": {
+            "Content-Type": "application/json",
+            "Cache-Control": "no-store",
+        },
+        "body": json.dumps(report, indent=2),
+    }, **CORS_HEADERS)
+
+
+def lambda_handler(event, context):
+    if wants_profile(event.get("queryStringParameters") or {}):
+        return profiled_request(event, context)
+    return handle_request(event, context)
 
 
 if __name__ == '__main__':
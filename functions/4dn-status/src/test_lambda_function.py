@@ -1,16 +1,35 @@
+import base64
 import contextlib
 import datetime
+import gzip
+import io
 import json
+import random
+import requests
+import sys
+import threading
+import types
 import unittest
 
+from dcicutils import env_utils
 from dcicutils.exceptions import InvalidParameterError
-from dcicutils.misc_utils import ref_now, REF_TZ, as_datetime, in_datetime_interval
+from dcicutils.misc_utils import ref_now, REF_TZ, as_datetime, in_datetime_interval, ignored
 from dcicutils.qa_utils import ControlledTime
 from unittest import mock
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, ReadTimeoutError
 from . import lambda_function as lambda_function_module
 from .lambda_function import (
     lambda_handler, DEFAULT_DATA, DEFAULT_DATA_EVENTS,
-    get_calendar_data, CALENDAR_DATA_URL_PRD, resolve_environment,
+    get_calendar_data, CALENDAR_DATA_URL_PRD, CALENDAR_DATA_URL_STG, CALENDAR_CACHE, resolve_environment,
+    get_calendar_session, set_calendar_session, make_calendar_session,
+    CALENDAR_FETCH_TIMEOUT, CALENDAR_FETCH_RETRIES, calendar_fetch_worst_case_seconds,
+    compile_calendar, compiled_calendar, filter_data, as_epoch, CompiledEvent, IntervalIndex,
+    CompiledCalendar, timeline, filter_timeline, ALL_PRIORITY_NAMES,
+    PRECOMPILED_KEY, precompiled_events,
+    environment_memo_stats, clear_environment_memos, ENVIRONMENT_MEMO_SIZE,
+    cache_control_max_age, CACHE_CONTROL_MAX_AGE_SECONDS, RESPONSE_CACHE,
+    HtmlTemplate, convert_to_html, negotiate_encoding, CONTENT_ENCODERS, dump_json,
+    known_environments, filter_environments, batch_environments, MAX_BATCH_ENVIRONMENTS,
     CALENDAR_MISSING_PRIORITY, CALENDAR_MISSING_MESSAGE,
     PRIORITY_RED, PRIORITY_ORANGE, PRIORITY_GREEN, PRIORITY_YELLOW, merge_priorities,
 )
@@ -140,14 +159,22 @@ class ApiTestCaseBase(unittest.TestCase):
 
     class FakeResponse:
 
-        def __init__(self, *, json):
+        def __init__(self, *, json, status_code=200, headers=None):
             self._json = json
+            self.status_code = status_code
+            self.headers = headers or {}
+
+        @property
+        def content(self):
+            return b"" if self.status_code == 304 else json.dumps(self._json).encode('utf-8')
 
         def json(self):
+            if self.status_code == 304:
+                raise AssertionError("A 304 response has no body to parse.")
             return self._json
 
         def raise_for_status(self):
-            if self._json is None:
+            if self._json is None and self.status_code != 304:
                 raise RuntimeError("Simulated HTTP request error.")
 
 
@@ -189,6 +216,50 @@ def sample_data():
         yield
 
 
+@contextlib.contextmanager
+def mocked_calendar_get():
+    with mock.patch.object(get_calendar_session(), "get") as mock_get:
+        yield mock_get
+
+
+class StandInTransport(requests.adapters.BaseAdapter):
+    """
+    A transport that can be mounted on a requests.Session to answer requests locally.
+    The responder is given each request and returns a (status_code, headers, body) tuple.
+    """
+
+    def __init__(self, responder):
+        super().__init__()
+        self.responder = responder
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append((request, kwargs))
+        status_code, headers, body = self.responder(request)
+        response = requests.models.Response()
+        response.status_code = status_code
+        response.headers = requests.structures.CaseInsensitiveDict(headers)
+        response._content = body
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def calendar_transport(responder):
+    transport = StandInTransport(responder)
+    session = make_calendar_session()
+    session.mount("https://", transport)
+    old_session = set_calendar_session(session)
+    try:
+        yield transport
+    finally:
+        set_calendar_session(old_session)
+
+
 @contextlib.contextmanager
 def datetime_for_testing(dt):
     dt = ControlledTime(dt)
@@ -196,7 +267,7 @@ def datetime_for_testing(dt):
         yield dt
 
 
-HEADER_PARAMS = ('referer',)
+HEADER_PARAMS = ('referer', 'if-none-match', 'accept-encoding')
 
 
 def event_with_qs_params(**params):
@@ -368,6 +439,418 @@ class TestApi(ApiTestCase):
                                                             environment=environment),
                                        expected_events=expected_events)
 
+    def test_cache_control(self):
+        with sample_data():
+            with datetime_for_testing(datetime.datetime(2020, 8, 31, 23, 50, 0)):
+                res = lambda_handler(event_with_qs_params(environment='fourfront-mastertest'), context=None)
+                directive, max_age = res['headers']['Cache-Control'].split("=")
+                self.assertEqual(directive, "public, max-age")
+                # The controlled clock ticks along a little each time it is consulted.
+                self.assertAlmostEqual(int(max_age), 600, delta=10)
+            # A response about some other time mustn't be given by a shared cache to anyone else.
+            res = lambda_handler(event_with_qs_params(environment='fourfront-mastertest',
+                                                      now="2020-08-31 23:50:00-0400"),
+                                 context=None)
+            self.assertEqual(res['headers']['Cache-Control'], "no-store")
+
+    def test_response_cache(self):
+        RESPONSE_CACHE.clear()
+        with sample_data():
+            with mock.patch.object(lambda_function_module, "render_body",
+                                   wraps=lambda_function_module.render_body) as mock_render:
+
+                with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+                    for response_format in ['json', 'html', 'json', 'html']:
+                        res = lambda_handler(event_with_qs_params(environment='fourfront-mastertest',
+                                                                  format=response_format),
+                                             context=None)
+                        self.assertEqual(res['statusCode'], 200)
+                    self.assertEqual(mock_render.call_count, 2)
+                    json_body = lambda_handler(event_with_qs_params(environment='fourfront-mastertest',
+                                                                    format='json'),
+                                               context=None)['body']
+                    self.assertEqual(json.loads(json_body)['calendar'], [SAMPLE_FF_SUMMER_NOTICE])
+                    self.assertEqual(RESPONSE_CACHE.stats()["hits"], 3)
+                    self.assertEqual(RESPONSE_CACHE.stats()["size"], 2)
+
+                    # Debugging and time overrides are never cached.
+                    lambda_handler(event_with_qs_params(environment='fourfront-mastertest', debug='true'),
+                                   context=None)
+                    lambda_handler(event_with_qs_params(environment='fourfront-mastertest',
+                                                        now="2020-07-01 00:00:00"),
+                                   context=None)
+                    self.assertEqual(mock_render.call_count, 4)
+                    self.assertEqual(RESPONSE_CACHE.stats()["size"], 2)
+
+                    # Nor are responses about a calendar that couldn't be had, however it failed.
+                    for problem in ["RuntimeError: Some error.", "RuntimeError: Some other error."]:
+                        missing_data = {"priority": CALENDAR_MISSING_PRIORITY, "calendar": [],
+                                        "message": CALENDAR_MISSING_MESSAGE, "problems": [{"message": problem}]}
+                        with mock.patch.object(lambda_function_module, "get_calendar_data") as mock_get_data:
+                            mock_get_data.return_value = missing_data
+                            res = lambda_handler(event_with_qs_params(environment='fourfront-mastertest'),
+                                                 context=None)
+                        self.assertEqual(res['statusCode'], 200)
+                        self.assertNotIn('ETag', res['headers'])
+                    self.assertEqual(mock_render.call_count, 6)
+                    self.assertEqual(RESPONSE_CACHE.stats()["size"], 2)
+
+                # Once the set of active events changes, so does the response.
+                with datetime_for_testing(AFTER_SAMPLE_BLOCK2):
+                    json_body = lambda_handler(event_with_qs_params(environment='fourfront-mastertest',
+                                                                    format='json'),
+                                               context=None)['body']
+                    self.assertEqual(json.loads(json_body)['calendar'], [])
+                    self.assertEqual(mock_render.call_count, 7)
+        RESPONSE_CACHE.clear()
+
+    def test_batch(self):
+        RESPONSE_CACHE.clear()
+
+        def respond(**params):
+            res = lambda_handler(event_with_qs_params(**params), context=None)
+            self.assertEqual(res['statusCode'], 200)
+            self.assertEqual(res['headers']['Content-Type'], 'application/json')
+            return json.loads(res['body'])
+
+        with sample_data():
+            with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+                with mock.patch.object(lambda_function_module, "filter_data") as mock_filter_data:
+                    result = respond(environments='fourfront-mastertest, fourfront-blue,fourfront-cgapwolf')
+                    mock_filter_data.assert_not_called()
+                self.assertEqual(result, {
+                    "priority": PRIORITY_ORANGE,
+                    "environments": {
+                        "fourfront-mastertest": {"priority": PRIORITY_ORANGE, "calendar": [SAMPLE_FF_SUMMER_NOTICE]},
+                        "fourfront-blue": {"priority": PRIORITY_GREEN, "calendar": []},
+                        "fourfront-cgapwolf": {"priority": PRIORITY_ORANGE, "calendar": [SAMPLE_CG_SUMMER_NOTICE]},
+                    },
+                })
+                # Each environment's result is what a request about it alone would get.
+                for name, env_result in result["environments"].items():
+                    single = respond(environment=name, format='json')
+                    self.assertEqual(env_result, {"priority": single["priority"], "calendar": single["calendar"]})
+                # A batch response is cached and tagged like any other.
+                self.assertEqual(RESPONSE_CACHE.stats()["size"], 4)
+                respond(environments='fourfront-mastertest, fourfront-blue,fourfront-cgapwolf')
+                self.assertEqual(RESPONSE_CACHE.stats()["size"], 4)
+
+                everything = respond(environment='*')
+                self.assertEqual(list(everything["environments"])[:2], ['fourfront-webprod', 'fourfront-cgap'])
+                self.assertNotIn('fourfront-webprod2', everything["environments"])  # it's fourfront-webprod
+                self.assertEqual(everything["environments"]["fourfront-mastertest"]["calendar"],
+                                 [SAMPLE_FF_SUMMER_NOTICE])
+
+            with datetime_for_testing(DURING_SAMPLE_BLOCK1):
+                result = respond(environments='fourfront-webprod,fourfront-cgap')
+                self.assertEqual(result["priority"], PRIORITY_ORANGE)
+                self.assertEqual(result["environments"]["fourfront-cgap"]["priority"], PRIORITY_GREEN)
+
+            too_many = ",".join("env%s" % i for i in range(MAX_BATCH_ENVIRONMENTS + 1))
+            res = lambda_handler(event_with_qs_params(environments=too_many), context=None)
+            self.assertIn("At most", res['message'])
+        RESPONSE_CACHE.clear()
+
+    def test_filter_environments(self):
+        data = {
+            "calendar": [
+                {
+                    "name": "bad",
+                    "start_time": "not a time",
+                    "affects": {"environments": ["fourfront-wolf", "fourfront-special"]},
+                },
+                SAMPLE_FF_SUMMER_NOTICE,
+            ],
+            "problems": [{"message": "earlier"}],
+        }
+        self.assertEqual(batch_environments(data), None)
+        self.assertEqual(batch_environments(data, environments="fourfront-green"),
+                         {"fourfront-green": "fourfront-webprod"})
+        environments = known_environments(data)
+        self.assertEqual(environments[-1], "fourfront-special")  # named only by the calendar
+        # Newer versions of dcicutils have the production and test environment names only in env_utils_legacy.
+        env_utils_legacy = types.ModuleType("dcicutils.env_utils_legacy")
+        for name in ["FF_PROD_BUCKET_ENV", "CGAP_PROD_BUCKET_ENV", "BEANSTALK_TEST_ENVS"]:
+            setattr(env_utils_legacy, name, getattr(env_utils, name))
+        with mock.patch.dict(sys.modules, {"dcicutils.env_utils": types.ModuleType("dcicutils.env_utils"),
+                                           "dcicutils.env_utils_legacy": env_utils_legacy}):
+            self.assertEqual(known_environments(data), environments)
+        result = filter_environments(data, {"fourfront-mastertest": "fourfront-mastertest",
+                                            "fourfront-wolf": "fourfront-wolf"},
+                                     now="2020-07-01 12:00:00")
+        self.assertEqual(result["priority"], PRIORITY_ORANGE)
+        self.assertEqual(result["environments"]["fourfront-wolf"], {"priority": PRIORITY_GREEN, "calendar": []})
+        self.assertEqual([problem.get("event", {}).get("name") for problem in result["problems"]], [None, "bad"])
+
+    def test_timeline_query(self):
+        RESPONSE_CACHE.clear()
+        with sample_data():
+            with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+                event = event_with_qs_params(environment='fourfront-cgapwolf',
+                                             **{'from': "2020-01-01 00:00:00", 'to': "2020-12-31 00:00:00"})
+                res = lambda_handler(event, context=None)
+                self.assertEqual(res['headers']['Content-Type'], 'application/json')
+                result = json.loads(res['body'])
+                self.assertEqual([segment["priority"] for segment in result["timeline"]],
+                                 [PRIORITY_GREEN, PRIORITY_ORANGE, PRIORITY_GREEN])
+                self.assertEqual(result["timeline"][1]["calendar"], [SAMPLE_CG_SUMMER_NOTICE])
+                # A timeline with both ends given is the same whenever it's asked for, so it's cached.
+                self.assertIn('ETag', res['headers'])
+                self.assertEqual(lambda_handler(event, context=None)['body'], res['body'])
+                self.assertEqual(RESPONSE_CACHE.stats()["hits"], 1)
+                # One that starts now is not.
+                res = lambda_handler(event_with_qs_params(environment='fourfront-cgapwolf', to="2020-12-31 00:00:00"),
+                                     context=None)
+                self.assertNotIn('ETag', res['headers'])
+                self.assertEqual(len(json.loads(res['body'])["timeline"]), 2)
+        RESPONSE_CACHE.clear()
+
+    def test_json_formatting(self):
+        RESPONSE_CACHE.clear()
+
+        def respond(**params):
+            return lambda_handler(event_with_qs_params(environment='fourfront-mastertest', format='json', **params),
+                                  context=None)
+
+        with sample_data():
+            with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+                compact = respond()
+                self.assertNotIn("\n", compact['body'])
+                self.assertNotIn(", ", compact['body'])
+                self.assertIn(compact['headers']['X-JSON-Encoder'], ['json', 'orjson'])
+                pretty = respond(pretty='true')
+                self.assertIn('\n  "calendar": [', pretty['body'])
+                self.assertEqual(json.loads(compact['body']), json.loads(pretty['body']))
+                self.assertNotEqual(compact['headers']['ETag'], pretty['headers']['ETag'])
+                self.assertEqual(RESPONSE_CACHE.stats()["size"], 2)
+                self.assertEqual(respond()['body'], compact['body'])
+                self.assertEqual(respond(pretty='true')['body'], pretty['body'])
+                # Debugging output is pretty unless asked otherwise.
+                self.assertIn("\n", respond(debug='true')['body'])
+                self.assertNotIn("\n", respond(debug='true', pretty='false')['body'])
+                # HTML isn't affected.
+                html_event = event_with_qs_params(environment='fourfront-mastertest', pretty='true')
+                self.assertEqual(lambda_handler(html_event, context=None)['body'],
+                                 lambda_handler(event_with_qs_params(environment='fourfront-mastertest'),
+                                                context=None)['body'])
+        RESPONSE_CACHE.clear()
+
+    def test_dump_json(self):
+        data = {"priority": "green", "calendar": [{"name": "x", "size": 2 ** 70}]}
+        with mock.patch.object(lambda_function_module, "orjson", None):
+            self.assertEqual(dump_json(data), ('json', '{"priority":"green","calendar":[{"name":"x","size":%d}]}'
+                                               % 2 ** 70))
+            self.assertEqual(dump_json(data, pretty=True), ('json', json.dumps(data, indent=2)))
+
+        class FakeOrjson:
+            OPT_INDENT_2 = 2
+
+            @staticmethod
+            def dumps(data, option=0):
+                if option != 0 or "calendar" in data:
+                    raise TypeError("Integer exceeds 64-bit range")
+                return b'{"fast":true}'
+
+        with mock.patch.object(lambda_function_module, "orjson", FakeOrjson):
+            self.assertEqual(dump_json({"fast": True}), ('orjson', '{"fast":true}'))
+            # If orjson can't manage, json is used instead.
+            self.assertEqual(dump_json(data)[0], 'json')
+            self.assertEqual(dump_json({"fast": True}, pretty=True), ('json', '{\n  "fast": true\n}'))
+
+    def test_negotiate_encoding(self):
+        self.assertEqual(negotiate_encoding(None), None)
+        self.assertEqual(negotiate_encoding(""), None)
+        self.assertEqual(negotiate_encoding("identity"), None)
+        self.assertEqual(negotiate_encoding("gzip"), 'gzip')
+        self.assertEqual(negotiate_encoding("deflate, GZIP;q=0.5"), 'gzip')
+        self.assertEqual(negotiate_encoding("gzip;q=0"), None)
+        self.assertEqual(negotiate_encoding("*"), 'br' if 'br' in CONTENT_ENCODERS else 'gzip')
+        self.assertEqual(negotiate_encoding("*, br;q=0"), 'gzip')
+        self.assertEqual(negotiate_encoding("gzip;q=0.2, br;q=0.8"), 'br' if 'br' in CONTENT_ENCODERS else 'gzip')
+        self.assertEqual(negotiate_encoding("gzip;q=0.8, br;q=0.2"), 'gzip')
+
+    def test_compression(self):
+        RESPONSE_CACHE.clear()
+
+        def respond(**params):
+            return lambda_handler(event_with_qs_params(environment='fourfront-mastertest', format='json', **params),
+                                  context=None)
+
+        with sample_data():
+            with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+                plain = respond()
+                self.assertNotIn('Content-Encoding', plain['headers'])
+                self.assertNotIn('isBase64Encoded', plain)
+                with mock.patch.object(lambda_function_module, "render_body",
+                                       wraps=lambda_function_module.render_body) as mock_render:
+                    with mock.patch.object(lambda_function_module, "encode_body",
+                                           wraps=lambda_function_module.encode_body) as mock_encode:
+                        for _ in range(2):
+                            res = respond(**{'accept-encoding': 'gzip, deflate'})
+                            self.assertEqual(res['statusCode'], 200)
+                            self.assertTrue(res['isBase64Encoded'])
+                            self.assertEqual(res['headers']['Content-Encoding'], 'gzip')
+                            self.assertEqual(res['headers']['Vary'], 'Accept-Encoding')
+                            self.assertEqual(gzip.decompress(base64.b64decode(res['body'])).decode('utf-8'),
+                                             plain['body'])
+                        # The compressed variant is made once from the cached rendering, then cached itself.
+                        self.assertEqual(mock_render.call_count, 0)
+                        self.assertEqual(mock_encode.call_count, 1)
+                # Each encoding is a different representation, so it gets a different tag.
+                gzip_etag = res['headers']['ETag']
+                self.assertNotEqual(gzip_etag, plain['headers']['ETag'])
+                self.assertEqual(respond(**{'accept-encoding': 'gzip', 'if-none-match': gzip_etag})['statusCode'],
+                                 304)
+                self.assertEqual(respond(**{'if-none-match': gzip_etag})['statusCode'], 200)
+        RESPONSE_CACHE.clear()
+
+    def test_gzip_encoding(self):
+        RESPONSE_CACHE.clear()
+        with sample_data():
+            with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+                plain = lambda_handler(event_with_qs_params(environment='fourfront-mastertest'), context=None)
+                res = lambda_handler(event_with_qs_params(environment='fourfront-mastertest',
+                                                          **{'accept-encoding': 'gzip'}),
+                                     context=None)
+        RESPONSE_CACHE.clear()
+        self.assertEqual(res['statusCode'], 200)
+        self.assertEqual(res['headers']['Content-Encoding'], 'gzip')
+        compressed = base64.b64decode(res['body'])
+        self.assertEqual(gzip.decompress(compressed).decode('utf-8'), plain['body'])
+        # The header's modification time is zeroed, so the same body always compresses the same way.
+        self.assertEqual(compressed[4:8], b'\0\0\0\0')
+        self.assertEqual(CONTENT_ENCODERS['gzip'](b'some text'), CONTENT_ENCODERS['gzip'](b'some text'))
+
+    def test_etag(self):
+
+        def respond(**params):
+            return lambda_handler(event_with_qs_params(environment='fourfront-mastertest', **params), context=None)
+
+        with sample_data():
+            with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+                res = respond(format='json')
+                etag = res['headers']['ETag']
+                self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+                self.assertNotEqual(respond()['headers']['ETag'], etag)  # html is a different representation
+
+                with mock.patch.object(lambda_function_module, "render_body") as mock_render:
+                    for if_none_match in [etag, 'W/' + etag, '"other", ' + etag, '*']:
+                        res = respond(format='json', **{'if-none-match': if_none_match})
+                        self.assertEqual(res['statusCode'], 304)
+                        self.assertEqual(res['body'], "")
+                        self.assertEqual(res['headers']['ETag'], etag)
+                    mock_render.assert_not_called()
+
+                self.assertEqual(respond(format='json', **{'if-none-match': '"other"'})['statusCode'], 200)
+                # After a change to how responses are rendered, the tags given out before no longer match.
+                with mock.patch.object(lambda_function_module, "RESPONSE_FORMAT_VERSION",
+                                       lambda_function_module.RESPONSE_FORMAT_VERSION + 1):
+                    res = respond(format='json', **{'if-none-match': etag})
+                    self.assertEqual(res['statusCode'], 200)
+                    self.assertNotEqual(res['headers']['ETag'], etag)
+                # Debugging output isn't tagged, so it is always sent.
+                res = respond(format='json', debug='true', **{'if-none-match': etag})
+                self.assertEqual(res['statusCode'], 200)
+                self.assertNotIn('ETag', res['headers'])
+
+            # Once the active events change, the old tag no longer matches.
+            with datetime_for_testing(AFTER_SAMPLE_BLOCK2):
+                res = respond(format='json', **{'if-none-match': etag})
+                self.assertEqual(res['statusCode'], 200)
+                self.assertNotEqual(res['headers']['ETag'], etag)
+
+    def test_request_metrics(self):
+
+        def respond(**params):
+            return lambda_handler(event_with_qs_params(environment='fourfront-mastertest', **params), context=None)
+
+        def server_timing(res):
+            return dict(entry.split(";", 1) for entry in res['headers']['Server-Timing'].split(", "))
+
+        RESPONSE_CACHE.clear()
+        with sample_data():
+            with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+
+                # By default, there's neither a header nor a log line.
+                with mock.patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+                    self.assertNotIn('Server-Timing', respond(format='json')['headers'])
+                self.assertEqual(mock_stdout.getvalue(), "")
+
+                with mock.patch.object(lambda_function_module, "SERVER_TIMING", True):
+                    RESPONSE_CACHE.clear()
+                    timing = server_timing(respond(format='json'))
+                    for stage in ['fetch', 'compile', 'resolve', 'filter', 'render', 'total']:
+                        self.assertTrue(timing[stage].startswith("dur="))
+                    self.assertEqual(timing['calendar_events'], "desc=%s" % len(SAMPLE_EVENTS))
+                    self.assertEqual(timing['active_events'], "desc=1")
+                    self.assertEqual(timing['response_cache_hit'], "desc=0")
+                    self.assertEqual(timing['calendar_bytes_saved'], "desc=0")  # The sample calendar isn't fetched.
+                    # The second time, it's not filtered or rendered again.
+                    timing = server_timing(respond(format='json'))
+                    self.assertNotIn('filter', timing)
+                    self.assertNotIn('render', timing)
+                    self.assertEqual(timing['response_cache_hit'], "desc=1")
+
+                with mock.patch.object(lambda_function_module, "METRICS_LOG", True):
+                    with mock.patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+                        res = respond(format='json', **{'accept-encoding': 'gzip'})
+                        self.assertNotIn('Server-Timing', res['headers'])
+                        etag = res['headers']['ETag']
+                        respond(format='json', **{'accept-encoding': 'gzip', 'if-none-match': etag})
+                    first, second = [json.loads(line) for line in mock_stdout.getvalue().splitlines()]
+                    directive, = first['_aws']['CloudWatchMetrics']
+                    self.assertEqual(directive['Namespace'], "4dn-status")
+                    self.assertEqual(directive['Dimensions'], [["Endpoint"]])
+                    # Every metric declared has a value in the record.
+                    for metric in directive['Metrics']:
+                        self.assertIsInstance(first[metric['Name']], (int, float))
+                    self.assertEqual(first['Endpoint'], "/4dn-status")
+                    self.assertEqual(first['environment'], "fourfront-mastertest")
+                    self.assertEqual(first['format'], "json")
+                    self.assertIn('encode_ms', first)
+                    self.assertEqual(first['not_modified'], 0)
+                    self.assertEqual(second['not_modified'], 1)
+                    self.assertNotIn('render_ms', second)
+
+    def test_profile(self):
+
+        def respond(**params):
+            return lambda_handler(event_with_qs_params(environment='fourfront-mastertest', **params), context=None)
+
+        with sample_data():
+            with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+                expected = respond(format='json')
+
+                # Unless profiling is enabled, the parameter is ignored.
+                self.assertEqual(respond(format='json', profile='true'), expected)
+
+                with mock.patch.object(lambda_function_module, "PROFILING", True):
+                    with mock.patch.object(lambda_function_module, "PROFILE_TOP_N", 1000):
+                        with mock.patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+                            # Even though the response is cached, the profile shows it being made.
+                            res = respond(format='json', profile='true')
+                    self.assertEqual(res['statusCode'], 200)
+                    self.assertEqual(res['headers']['Cache-Control'], "no-store")
+                    report = json.loads(res['body'])
+                    self.assertEqual(report['statusCode'], 200)
+                    self.assertGreater(report['total_calls'], 0)
+                    functions = [entry['function'] for entry in report['profile']]
+                    cumulative = [entry['cumulative_seconds'] for entry in report['profile']]
+                    self.assertEqual(cumulative, sorted(cumulative, reverse=True))
+                    self.assertIn('handle_request', functions[0])
+                    # Though the calendar was compiled and the environment resolved by the request before,
+                    # the profile shows the work of doing so, as on a cold start.
+                    for function in ['(filter_data)', '(render_body)', 'misc_utils.py',
+                                     '(compile_event)', 'env_utils.py', '(get_bucket_env)']:
+                        self.assertTrue(any(function in name for name in functions), function)
+                    # The profile is logged, too.
+                    self.assertIn("cumulative", mock_stdout.getvalue())
+                    self.assertIn("filter_data", mock_stdout.getvalue())
+
+                    with mock.patch.object(lambda_function_module, "PROFILE_TOP_N", 3):
+                        with mock.patch("sys.stdout", new_callable=io.StringIO):
+                            self.assertEqual(len(json.loads(respond(profile='true')['body'])['profile']), 3)
+
     def test_json_based_on_referer(self):
         # These work in pairs...
 
@@ -442,13 +925,14 @@ class TestInternals(ApiTestCaseBase):
 
     def test_get_calendar_data(self):
 
-        with mock.patch("requests.get") as mock_get:
+        with mocked_calendar_get() as mock_get:
 
             some_calendar = {"some": "calendar"}
             empty_calendar = {}
             no_calendar = None
 
-            def mocked_get(url):
+            def mocked_get(url, headers=None, timeout=None):
+                ignored(headers, timeout)
                 self.assertEqual(url, CALENDAR_DATA_URL_PRD)
                 if mocked_calendar == 'error':
                     raise RuntimeError("Some sort of error happened.")
@@ -456,12 +940,17 @@ class TestInternals(ApiTestCaseBase):
 
             mock_get.side_effect = mocked_get
 
+            # Each of these cases is about what a fresh fetch yields, so we discard anything cached.
+
+            CALENDAR_CACHE.clear()
             mocked_calendar = some_calendar
             self.assertEqual(get_calendar_data(), some_calendar)
 
+            CALENDAR_CACHE.clear()
             mocked_calendar = empty_calendar
             self.assertEqual(get_calendar_data(), DEFAULT_DATA)
 
+            CALENDAR_CACHE.clear()
             mocked_calendar = no_calendar
             expected_data = {
                 "calendar": [],
@@ -471,6 +960,7 @@ class TestInternals(ApiTestCaseBase):
             }
             self.assertEqual(get_calendar_data(), expected_data)
 
+            CALENDAR_CACHE.clear()
             mocked_calendar = 'error'
             expected_data = {
                 "calendar": [],
@@ -480,6 +970,453 @@ class TestInternals(ApiTestCaseBase):
             }
             self.assertEqual(get_calendar_data(), expected_data)
 
+    def test_get_calendar_data_caching(self):
+
+        clock_time = 1000.0
+        fetched = []
+
+        def mocked_get(url, headers=None, timeout=None):
+            ignored(headers, timeout)
+            fetched.append(url)
+            if mocked_calendar == 'error':
+                raise RuntimeError("Some sort of error happened.")
+            return self.FakeResponse(json=mocked_calendar)
+
+        with mocked_calendar_get() as mock_get:
+            with mock.patch.object(CALENDAR_CACHE, "clock", lambda: clock_time):
+                with mock.patch.object(CALENDAR_CACHE, "ttl_seconds", 60):
+                    with mock.patch.object(CALENDAR_CACHE, "max_staleness_seconds", 600):
+
+                        mock_get.side_effect = mocked_get
+                        CALENDAR_CACHE.clear()
+
+                        prd_calendar = {"calendar": [{"name": "production"}]}
+                        stg_calendar = {"calendar": [{"name": "staged"}]}
+
+                        mocked_calendar = prd_calendar
+                        self.assertEqual(get_calendar_data(), prd_calendar)
+                        mocked_calendar = stg_calendar
+                        self.assertEqual(get_calendar_data(staged=True), stg_calendar)
+                        self.assertEqual(fetched, [CALENDAR_DATA_URL_PRD, CALENDAR_DATA_URL_STG])
+
+                        # Within the ttl, the production and staged calendars are each served from the cache.
+                        clock_time += 59
+                        self.assertEqual(get_calendar_data(), prd_calendar)
+                        self.assertEqual(get_calendar_data(staged=True), stg_calendar)
+                        self.assertEqual(len(fetched), 2)
+                        self.assertEqual(CALENDAR_CACHE.stats()["hits"], 2)
+                        self.assertEqual(CALENDAR_CACHE.stats()["misses"], 2)
+
+                        # Once the ttl passes, an error keeps serving the last good copy ...
+                        clock_time += 2
+                        mocked_calendar = 'error'
+                        self.assertEqual(get_calendar_data(), prd_calendar)
+                        self.assertEqual(len(fetched), 3)
+                        # ... and doesn't retry again until another ttl has passed.
+                        self.assertEqual(get_calendar_data(), prd_calendar)
+                        self.assertEqual(len(fetched), 3)
+                        self.assertEqual(CALENDAR_CACHE.stats()["stale_hits"], 1)
+
+                        # A calendar that can't even be compiled doesn't replace the last good copy either.
+                        clock_time += 60
+                        mocked_calendar = ["not", "a", "calendar"]
+                        self.assertEqual(get_calendar_data(), prd_calendar)
+                        self.assertEqual(len(fetched), 4)
+                        self.assertEqual(get_calendar_data(), prd_calendar)
+                        self.assertEqual(len(fetched), 4)
+
+                        # Beyond the staleness bound, the failure is finally reported.
+                        clock_time += 600
+                        data = get_calendar_data()
+                        self.assertEqual(data["priority"], CALENDAR_MISSING_PRIORITY)
+                        self.assertEqual(data["message"], CALENDAR_MISSING_MESSAGE)
+
+                        CALENDAR_CACHE.clear()
+
+    def test_get_calendar_data_revalidation(self):
+
+        clock_time = 1000.0
+        some_calendar = {"calendar": [{"name": "some event"}]}
+        other_calendar = {"calendar": [{"name": "other event"}]}
+        validators = {"ETag": '"abc"', "Last-Modified": "Wed, 21 Oct 2020 07:28:00 GMT"}
+        requests_seen = []
+
+        def mocked_get(url, headers=None, timeout=None):
+            ignored(url, timeout)
+            requests_seen.append(headers)
+            if mocked_calendar == 'unchanged':
+                return self.FakeResponse(json=None, status_code=304)
+            return self.FakeResponse(json=mocked_calendar, headers=validators)
+
+        with mocked_calendar_get() as mock_get:
+            with mock.patch.object(CALENDAR_CACHE, "clock", lambda: clock_time):
+                with mock.patch.object(CALENDAR_CACHE, "ttl_seconds", 60):
+
+                    mock_get.side_effect = mocked_get
+                    CALENDAR_CACHE.clear()
+
+                    mocked_calendar = some_calendar
+                    data = get_calendar_data()
+                    self.assertEqual(data, some_calendar)
+                    self.assertEqual(requests_seen, [{}])
+
+                    # An unchanged calendar is not downloaded or parsed again.
+                    clock_time += 61
+                    mocked_calendar = 'unchanged'
+                    with mock.patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+                        self.assertIs(get_calendar_data(), data)
+                    self.assertIn("saving %d bytes and a parse" % len(json.dumps(some_calendar)),
+                                  mock_stdout.getvalue())
+                    self.assertEqual(requests_seen[-1], {"If-None-Match": '"abc"',
+                                                         "If-Modified-Since": "Wed, 21 Oct 2020 07:28:00 GMT"})
+                    stats = CALENDAR_CACHE.stats()
+                    self.assertEqual(stats["not_modified"], 1)
+                    self.assertEqual(stats["parses_saved"], 1)
+                    self.assertEqual(stats["bytes_saved"], len(json.dumps(some_calendar)))
+
+                    # A changed calendar replaces the cached one.
+                    clock_time += 61
+                    mocked_calendar = other_calendar
+                    self.assertEqual(get_calendar_data(), other_calendar)
+                    self.assertEqual(CALENDAR_CACHE.stats()["not_modified"], 1)
+
+                    CALENDAR_CACHE.clear()
+
+    def test_calendar_session(self):
+
+        session = make_calendar_session()
+        adapter = session.get_adapter(CALENDAR_DATA_URL_PRD)
+        self.assertEqual(adapter.max_retries.total, CALENDAR_FETCH_RETRIES)
+        self.assertIs(get_calendar_session(), get_calendar_session())
+
+        # A connection that fails is retried, but a read that times out is not.
+        url = CALENDAR_DATA_URL_PRD
+        retried = adapter.max_retries.increment(method='GET', url=url, error=ConnectTimeoutError(None, "timed out"))
+        self.assertEqual(retried.total, CALENDAR_FETCH_RETRIES - 1)
+        with self.assertRaises(MaxRetryError):
+            adapter.max_retries.increment(method='GET', url=url, error=ReadTimeoutError(None, url, "timed out"))
+        # So, at worst, only one attempt uses both timeouts, and the others give up after the connect timeout.
+        connect_timeout, read_timeout = CALENDAR_FETCH_TIMEOUT
+        worst_case = calendar_fetch_worst_case_seconds()
+        self.assertEqual(worst_case, 3 * connect_timeout + read_timeout + 0.5)
+        self.assertLess(worst_case, 2 * (connect_timeout + read_timeout))
+
+        some_calendar = {"calendar": [{"name": "some event"}]}
+
+        def responder(request):
+            if request.headers.get('If-None-Match') == '"v1"':
+                return 304, {}, b""
+            return 200, {"ETag": '"v1"'}, json.dumps(some_calendar).encode('utf-8')
+
+        CALENDAR_CACHE.clear()
+        with calendar_transport(responder) as transport:
+            with mock.patch.object(CALENDAR_CACHE, "ttl_seconds", 0):
+                self.assertEqual(get_calendar_data(), some_calendar)
+                self.assertEqual(get_calendar_data(), some_calendar)
+            [(request1, kwargs1), (request2, kwargs2)] = transport.sent
+            self.assertEqual(request1.url, CALENDAR_DATA_URL_PRD)
+            self.assertEqual(kwargs1['timeout'], CALENDAR_FETCH_TIMEOUT)
+            self.assertEqual(request2.headers['If-None-Match'], '"v1"')
+            self.assertEqual(CALENDAR_CACHE.stats()["not_modified"], 1)
+        CALENDAR_CACHE.clear()
+
+    def test_get_calendar_data_stale_while_revalidate(self):
+
+        clock_time = 1000.0
+        old_calendar = {"calendar": [{"name": "old event"}]}
+        new_calendar = {"calendar": [{"name": "new event"}]}
+        calendars = [old_calendar, new_calendar]
+        proceed = threading.Event()
+
+        def responder(request):
+            ignored(request)
+            calendar = calendars.pop(0)
+            if calendar is new_calendar:
+                proceed.wait(5)  # The background fetch is held up until we've checked what's served meanwhile.
+            return 200, {}, json.dumps(calendar).encode('utf-8')
+
+        CALENDAR_CACHE.clear()
+        with calendar_transport(responder) as transport:
+            with mock.patch.object(CALENDAR_CACHE, "clock", lambda: clock_time):
+                with mock.patch.object(CALENDAR_CACHE, "ttl_seconds", 60):
+                    with mock.patch.object(CALENDAR_CACHE, "stale_while_revalidate", True):
+
+                        # With nothing cached, the first request has to wait for the fetch.
+                        self.assertEqual(get_calendar_data(), old_calendar)
+
+                        # Once expired, the old calendar is served while a single refresh is under way.
+                        clock_time += 61
+                        for i in range(3):
+                            self.assertEqual(get_calendar_data(), old_calendar)
+                        self.assertEqual(CALENDAR_CACHE.stats()["background_refreshes"], 1)
+                        self.assertEqual(CALENDAR_CACHE.stats()["stale_hits"], 3)
+
+                        proceed.set()
+                        CALENDAR_CACHE.wait_for_refreshes(timeout=5)
+                        self.assertEqual(get_calendar_data(), new_calendar)
+                        self.assertEqual(len(transport.sent), 2)
+        CALENDAR_CACHE.clear()
+
+    def test_compile_calendar(self):
+
+        lead_time_event = dict(SAMPLE_FF_SUMMER_NOTICE, lead_time={"days": 1, "hours": 12})
+        numeric_lead_time_event = dict(SAMPLE_FF_SUMMER_NOTICE, lead_time=3600)
+        open_ended_event = {"name": "Forever", "priority": PRIORITY_YELLOW}
+        bad_time_event = dict(SAMPLE_CG_SUMMER_NOTICE, end_time="not a time")
+        data = {"calendar": [SAMPLE_FF_SYSTEM_UPGRADE, lead_time_event, numeric_lead_time_event,
+                             open_ended_event, bad_time_event]}
+
+        upgrade, lead_time, numeric_lead_time, open_ended, bad_time = compile_calendar(data).events
+
+        self.assertEqual(upgrade.index, 0)
+        self.assertIs(upgrade.event, SAMPLE_FF_SYSTEM_UPGRADE)
+        self.assertEqual(upgrade.start, as_epoch(START_SAMPLE_BLOCK1))
+        self.assertEqual(upgrade.end, as_epoch(END_SAMPLE_BLOCK1))
+        # The synonym fourfront-webprod2 is canonicalized away.
+        self.assertEqual(upgrade.environments, {"fourfront-hotseat", "fourfront-mastertest",
+                                                "fourfront-webdev", "fourfront-webprod"})
+        self.assertIsNone(upgrade.error)
+
+        self.assertEqual(lead_time.start, as_epoch(START_SAMPLE_BLOCK2) - 36 * 3600)
+        self.assertEqual(numeric_lead_time.start, as_epoch(START_SAMPLE_BLOCK2) - 3600)
+        self.assertEqual(lead_time.end, as_epoch(END_SAMPLE_BLOCK2))
+
+        self.assertIsNone(open_ended.start)
+        self.assertIsNone(open_ended.end)
+        self.assertIsNone(open_ended.environments)
+        self.assertEqual(open_ended.priority, 1)
+        self.assertTrue(open_ended.affects("fourfront-anything"))
+        self.assertTrue(open_ended.is_active(0))
+
+        self.assertTrue(bad_time.error)
+        self.assertTrue(bad_time.affects("fourfront-cgapwolf"))
+        self.assertFalse(bad_time.affects("fourfront-mastertest"))
+
+        # Compiling is done once per calendar data.
+        self.assertIs(compiled_calendar(data), compiled_calendar(data))
+
+    def test_precompiled_calendar(self):
+
+        def summary(calendar):
+            return [(e.index, e.event, e.start, e.end, e.priority, e.environments, e.error) for e in calendar.events]
+
+        lead_event = dict(SAMPLE_FF_SUMMER_NOTICE, priority=PRIORITY_RED, lead_time={"days": 1})
+        everywhere_event = {"name": "Everywhere", "start_time": START_SAMPLE_BLOCK2}
+        data = {"calendar": [SAMPLE_FF_SYSTEM_UPGRADE, lead_event, everywhere_event]}
+        compiled = compile_calendar(data)
+        # What's stored must survive being written as JSON.
+        precompiled_data = json.loads(json.dumps(dict(data, **{PRECOMPILED_KEY: precompiled_events(compiled.events)})))
+        with mock.patch.object(lambda_function_module, "compile_event") as mock_compile_event:
+            self.assertEqual(summary(compile_calendar(precompiled_data)), summary(compiled))
+            mock_compile_event.assert_not_called()
+
+        # If the events have been edited since they were compiled, or the format isn't understood,
+        # the calendar is compiled as usual.
+        edited_data = dict(precompiled_data, calendar=[SAMPLE_FF_SYSTEM_UPGRADE, SAMPLE_FF_SUMMER_NOTICE,
+                                                       everywhere_event])
+        self.assertEqual(summary(compile_calendar(edited_data)),
+                         summary(compile_calendar({"calendar": edited_data["calendar"]})))
+        for precompiled in [None, [], dict(precompiled_data[PRECOMPILED_KEY], format=0),
+                            dict(precompiled_data[PRECOMPILED_KEY], events=[[1, 2, 3]] * 3)]:
+            self.assertEqual(summary(compile_calendar(dict(precompiled_data, **{PRECOMPILED_KEY: precompiled}))),
+                             summary(compiled))
+
+        # The digest doesn't cover the records themselves, so a malformed record (as from a hand edit)
+        # must be caught, rather than breaking every request.
+        start, end, priority, environments = precompiled_data[PRECOMPILED_KEY]["events"][1]
+        for record in [["2020-06-01", end, priority, environments], [start, True, priority, environments],
+                       [start, end, "purple", environments], [start, end, priority, "fourfront-mastertest"],
+                       [start, end, priority, [1]], [start, end, priority], {"start": start}]:
+            malformed = json.loads(json.dumps(precompiled_data))
+            malformed[PRECOMPILED_KEY]["events"][1] = record
+            self.assertIsNone(lambda_function_module.load_precompiled_events(malformed), record)
+            self.assertEqual(summary(compile_calendar(malformed)), summary(compiled))
+            with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+                with mock.patch.object(lambda_function_module, "get_calendar_data", return_value=malformed):
+                    res = lambda_handler(event_with_qs_params(environment='fourfront-mastertest', format='json'),
+                                         context=None)
+            self.assertEqual(res['statusCode'], 200)
+
+    def test_interval_index(self):
+
+        rng = random.Random(4)
+        events = []
+        for i in range(300):
+            start = rng.choice([None, rng.randrange(0, 1000)])
+            end = rng.choice([None, rng.randrange(0, 1000)])
+            events.append(CompiledEvent(i, {"name": "Event %s" % i}, start=start, end=end))
+        index = IntervalIndex(events)
+        self.assertEqual(len(index), 300)
+        # Whole numbers hit the boundaries exactly, to check that both ends are inclusive.
+        for when in [-1, 0, 0.5, 17, 250, 999, 999.5, 1000]:
+            self.assertEqual(index.active_at(when), [event for event in events if event.is_active(when)])
+
+        self.assertEqual(IntervalIndex([]).active_at(0), [])
+        only_event = CompiledEvent(0, {}, start=None, end=None)
+        self.assertEqual(IntervalIndex([only_event]).active_at(0), [only_event])
+
+    def test_timeline(self):
+
+        rng = random.Random(17)
+        events = []
+        for i in range(200):
+            start = rng.choice([None, rng.randrange(0, 1000)])
+            end = rng.choice([None, rng.randrange(0, 1000)])
+            events.append(CompiledEvent(i, {"name": "Event %s" % i}, start=start, end=end,
+                                        priority=rng.randrange(len(ALL_PRIORITY_NAMES))))
+        calendar = CompiledCalendar({}, events)
+        index = calendar.index_for("fourfront-anything")
+
+        def expected_priority(when):
+            return max([ALL_PRIORITY_NAMES.index(PRIORITY_GREEN)] + [e.priority for e in index.active_at(when)])
+
+        for start, end in [(100, 900), (-50, 1050), (250, 250), (17, 18)]:
+            segments = timeline(calendar, "fourfront-anything", start, end)
+            self.assertEqual(segments[0][0], start)
+            self.assertEqual(segments[-1][1], end)
+            for (_, until, _, _), (following_start, _, _, _) in zip(segments, segments[1:]):
+                self.assertEqual(until, following_start)
+            for segment_start, until, priority, active in segments:
+                # Each stretch has the same events throughout, including just before its end.
+                # (Times are only meaningful to the microsecond, so the stretch just after an end isn't sampled.)
+                samples = [segment_start] if until - segment_start < 1e-5 else [segment_start,
+                                                                                (segment_start + until) / 2,
+                                                                                until - 1e-5]
+                for when in samples:
+                    self.assertEqual(active, index.active_at(when))
+                    self.assertEqual(priority, expected_priority(when))
+            # The last stretch includes the end of the range.
+            self.assertEqual(segments[-1][3], index.active_at(end))
+
+        # Events are active through their end times.
+        only_event = CompiledEvent(0, {}, start=10, end=20)
+        segments = timeline(CompiledCalendar({}, [only_event]), "fourfront-anything", 0, 30)
+        self.assertEqual([(s, u, active) for s, u, _, active in segments],
+                         [(0, 10, []), (10, 20.000001, [only_event]), (20.000001, 30, [])])
+
+    def test_filter_timeline(self):
+        data = {"calendar": SAMPLE_EVENTS}
+        result = filter_timeline(data, "fourfront-mastertest", "2020-01-01 00:00:00", "2020-12-31 00:00:00")
+        self.assertEqual(result["priority"], PRIORITY_ORANGE)
+        self.assertEqual(result["from"], "2020-01-01 00:00:00-05:00")
+        self.assertEqual(result["to"], "2020-12-31 00:00:00-05:00")
+        self.assertEqual([(segment["from"], segment["until"], segment["priority"],
+                           [event["name"] for event in segment["calendar"]])
+                          for segment in result["timeline"]],
+                         [("2020-01-01 00:00:00-05:00", "2020-02-01 16:00:00-05:00", PRIORITY_GREEN, []),
+                          ("2020-02-01 16:00:00-05:00", "2020-02-28 12:00:00.000001-05:00", PRIORITY_ORANGE,
+                           ["Fourfront System Upgrades"]),
+                          ("2020-02-28 12:00:00.000001-05:00", "2020-06-01 00:00:00-04:00", PRIORITY_GREEN, []),
+                          ("2020-06-01 00:00:00-04:00", "2020-09-01 00:00:00.000001-04:00", PRIORITY_ORANGE,
+                           ["Fourfront Mastertest Summer Shutdown"]),
+                          ("2020-09-01 00:00:00.000001-04:00", "2020-12-31 00:00:00-05:00", PRIORITY_GREEN, [])])
+
+        with self.assertRaises(ValueError):
+            filter_timeline(data, "fourfront-mastertest", "2020-01-01 00:00:00")
+        with self.assertRaises(ValueError):
+            filter_timeline(data, "fourfront-mastertest", "2020-12-31 00:00:00", "2020-01-01 00:00:00")
+        # Without a start, the timeline starts now.
+        result = filter_timeline(data, "fourfront-mastertest", None, "2020-12-31 00:00:00", now="2020-07-01 00:00:00")
+        self.assertEqual(result["from"], "2020-07-01 00:00:00-04:00")
+        self.assertEqual(len(result["timeline"]), 2)
+
+    def test_compiled_calendar_environments(self):
+
+        everywhere_event = {"name": "Everywhere", "start_time": START_SAMPLE_BLOCK2}
+        data = {"calendar": [SAMPLE_FF_SYSTEM_UPGRADE, SAMPLE_FF_SUMMER_NOTICE, everywhere_event,
+                             SAMPLE_CG_SUMMER_NOTICE]}
+        calendar = compile_calendar(data)
+
+        def names(compiled_events):
+            return [compiled_event.event["name"] for compiled_event in compiled_events]
+
+        self.assertEqual(sorted(calendar.by_environment),
+                         ["fourfront-cgapwolf", "fourfront-hotseat", "fourfront-mastertest",
+                          "fourfront-webdev", "fourfront-webprod"])
+        self.assertEqual(names(calendar.events_for("fourfront-mastertest")),
+                         ["Fourfront System Upgrades", "Fourfront Mastertest Summer Shutdown", "Everywhere"])
+        self.assertEqual(names(calendar.events_for("fourfront-cgapwolf")),
+                         ["Everywhere", "CGAP Wolf Summer Shutdown"])
+        self.assertEqual(names(calendar.events_for("fourfront-unknown")), ["Everywhere"])
+
+        self.assertIs(calendar.index_for("fourfront-mastertest"), calendar.index_for("fourfront-mastertest"))
+        # Environments the calendar doesn't name share an index rather than getting one each.
+        self.assertIs(calendar.index_for("fourfront-unknown"), calendar.index_for("fourfront-other"))
+
+        when = as_epoch(DURING_SAMPLE_BLOCK2)
+        self.assertEqual(names(calendar.index_for("fourfront-mastertest").active_at(when)),
+                         ["Fourfront Mastertest Summer Shutdown", "Everywhere"])
+        self.assertEqual(names(calendar.index_for("fourfront-webprod").active_at(when)), ["Everywhere"])
+
+    def test_cache_control_max_age(self):
+
+        lead_time_event = dict(SAMPLE_FF_SUMMER_NOTICE, lead_time={"hours": 2})
+        data = {"calendar": [SAMPLE_FF_SYSTEM_UPGRADE, lead_time_event]}
+
+        with mock.patch.object(lambda_function_module, "CACHE_CONTROL_MAX_AGE_SECONDS", 10 ** 9):
+
+            def max_age(environment, now):
+                return cache_control_max_age(data, environment, now=now)
+
+            # An hour before the end of block 1, and an hour after it.
+            self.assertEqual(max_age('fourfront-webprod', "2020-02-28 11:00:00-0500"), 3600)
+            self.assertEqual(max_age('fourfront-webprod', END_SAMPLE_BLOCK1), 0)
+            # An event is only due to appear for mastertest at the start of block 2, less its lead time.
+            self.assertEqual(max_age('fourfront-mastertest', "2020-05-31 21:00:00-0400"), 3600)
+            self.assertEqual(max_age('fourfront-mastertest', "2020-05-31 20:00:00-0400"), 2 * 3600)
+            self.assertEqual(max_age('fourfront-mastertest', "2020-08-31 23:00:00-0400"), 3600)
+            # Once there is nothing more to happen, there's nothing to limit the time to.
+            self.assertEqual(max_age('fourfront-mastertest', "2020-09-01 01:00:00-0400"), 10 ** 9)
+            self.assertEqual(max_age('fourfront-cgapwolf', "2020-05-31 21:00:00-0400"), 10 ** 9)
+
+        self.assertEqual(cache_control_max_age(data, 'fourfront-webprod', now="2020-01-01 00:00:00"),
+                         CACHE_CONTROL_MAX_AGE_SECONDS)
+        missing_data = {"calendar": [], "message": CALENDAR_MISSING_MESSAGE}
+        self.assertEqual(cache_control_max_age(missing_data, 'fourfront-webprod'),
+                         min(CACHE_CONTROL_MAX_AGE_SECONDS, CALENDAR_CACHE.ttl_seconds))
+
+    def test_html_template(self):
+
+        template = HtmlTemplate("<p><<A>> and <<B>>, then <<A>> again</p>")
+        self.assertEqual(template.fragments, ["<p>", " and ", ", then ", " again</p>"])
+        self.assertEqual(template.slots, ["A", "B", "A"])
+        # Substituted values are used as given, even if they look like slots.
+        self.assertEqual(template.render(A="<<B>>", B="b"), "<p><<B>> and b, then <<B>> again</p>")
+
+    def test_convert_to_html(self):
+
+        body = convert_to_html({"priority": PRIORITY_YELLOW, "calendar": [SAMPLE_FF_SUMMER_NOTICE]},
+                               'fourfront-mastertest')
+        self.assertIn('<div class="banner bgcolor_yellow" id="banner">', body)
+        self.assertIn('<td class="page-name" valign="bottom">Fourfront Status</td>', body)
+        self.assertIn('<dt class="calendar-event">Fourfront Mastertest Summer Shutdown</dt>\n'
+                      '<dd>\n'
+                      '<p><span class="who">Fourfront Mastertest Users</span>'
+                      ' <span class="when">(2020-06-01 00:00:00-0400 to 2020-09-01 00:00:00-0400)</span></p>\n'
+                      '<p class="what">We&#x27;re all at the beach. Happy Summer!</p>\n',
+                      body)
+        self.assertNotIn('<<', body)
+
+    def test_filter_data_problems(self):
+
+        bad_time_event = dict(SAMPLE_CG_SUMMER_NOTICE, start_time="not a time")
+        data = {"calendar": [SAMPLE_FF_SUMMER_NOTICE, bad_time_event],
+                "problems": [{"message": "Some earlier problem."}]}
+
+        with datetime_for_testing(DURING_SAMPLE_BLOCK2):
+            # The problem with an event is reported only where the event would have been considered.
+            result = filter_data(data, 'fourfront-mastertest')
+            self.assertEqual(result["calendar"], [SAMPLE_FF_SUMMER_NOTICE])
+            self.assertEqual(result["problems"], [{"message": "Some earlier problem."}])
+            for i in range(2):
+                result = filter_data(data, 'fourfront-cgapwolf')
+                self.assertEqual(result["calendar"], [])
+                [earlier_problem, event_problem] = result["problems"]
+                self.assertIs(event_problem["event"], bad_time_event)
+                self.assertIn("not a time", event_problem["message"])
+        # The data given is not modified.
+        self.assertEqual(data["problems"], [{"message": "Some earlier problem."}])
+
     def test_in_datetime_interval(self):
 
         tz_est_offset = "-0500"       # US/Eastern Standard Time (EST) - 5 hours offset from UTC
@@ -639,3 +1576,37 @@ class TestInternals(ApiTestCaseBase):
 
         with self.assertRaises(InvalidParameterError):
             test(application='something', expected='fourfront-webprod')  # anything not cgap is assumed fourfront
+
+    def test_resolve_environment_memo(self):
+
+        clear_environment_memos()
+
+        for page in ("", "search/", "browse/?type=Experiment", "help"):
+            self.assertEqual(resolve_environment(host=None, referer=MASTERTEST_SERVER + page,
+                                                 application=None, environment=None),
+                             'fourfront-mastertest')
+        for i in range(3):
+            self.assertEqual(resolve_environment(host=None, referer=None, application=None,
+                                                 environment='fourfront-webprod2'),
+                             'fourfront-webprod')
+        # Hosts that aren't status hosts don't matter, so they don't get memo entries.
+        for i in range(3):
+            self.assertEqual(resolve_environment(host="host%s.example.com" % i, referer=None,
+                                                 application='cgap', environment=None),
+                             'fourfront-cgap')
+
+        stats = environment_memo_stats()
+        self.assertEqual(stats["resolve_environment"]["misses"], 2)
+        self.assertEqual(stats["resolve_environment"]["hits"], 5)
+        self.assertEqual(stats["canonicalize_environment"]["misses"], 1)
+        self.assertEqual(stats["canonicalize_environment"]["hits"], 2)
+
+        # However many referers we're sent, the memo stays bounded.
+        for i in range(ENVIRONMENT_MEMO_SIZE + 10):
+            resolve_environment(host=None, referer="https://server%s.example.com/" % i,
+                                application=None, environment=None)
+        stats = environment_memo_stats()["resolve_environment"]
+        self.assertEqual(stats["size"], ENVIRONMENT_MEMO_SIZE)
+        self.assertEqual(stats["max_size"], ENVIRONMENT_MEMO_SIZE)
+
+        clear_environment_memos()
@@ -0,0 +1,229 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+from .test_lambda_function import (
+    SAMPLE_DATA, SAMPLE_EVENTS, SAMPLE_FF_SUMMER_NOTICE, SAMPLE_FF_SYSTEM_UPGRADE, event_with_qs_params,
+)
+
+# The scripts are found next to this folder, whether that's src/ or the stg/ folder that brig-test makes.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import compile_calendar  # noQA - must come after sys.path is set up
+import prune_calendar  # noQA
+import render_snapshots  # noQA
+import serve_locally  # noQA
+
+
+# The scripts use lambda_function as a top-level module, which is a different module object than the one
+# the other tests use, so it's that one whose functions must be called or mocked here.
+lambda_function = render_snapshots.lambda_function
+
+SAMPLE_NOW = "2020-07-01 12:00:00-0400"
+
+
+class TestRenderSnapshots(unittest.TestCase):
+
+    def test_render_snapshots(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            manifest = render_snapshots.render_snapshots(SAMPLE_DATA, output_dir, now=SAMPLE_NOW)
+            with open(os.path.join(output_dir, "manifest.json")) as fp:
+                self.assertEqual(json.load(fp), manifest)
+            self.assertEqual(list(manifest["environments"]), lambda_function.known_environments(SAMPLE_DATA))
+            self.assertEqual(manifest["calendar_version"], lambda_function.compiled_calendar(SAMPLE_DATA).version)
+
+            # The manifest names exactly the files that were written.
+            named = {entry[extension] for entry in manifest["environments"].values() for extension in ["html", "json"]}
+            self.assertEqual(set(os.listdir(output_dir)), named | {"manifest.json"})
+
+            # Each snapshot is what the lambda would have said about its environment at that time.
+            with mock.patch.object(lambda_function, "get_calendar_data", return_value=SAMPLE_DATA):
+                for environment, entry in manifest["environments"].items():
+                    for response_format in ["html", "json"]:
+                        res = lambda_function.lambda_handler(event_with_qs_params(environment=environment,
+                                                                                  format=response_format,
+                                                                                  now=SAMPLE_NOW),
+                                                             context=None)
+                        with open(os.path.join(output_dir, entry[response_format])) as fp:
+                            self.assertEqual(fp.read(), res["body"], (environment, response_format))
+                    with open(os.path.join(output_dir, entry["json"])) as fp:
+                        self.assertEqual(json.load(fp)["priority"], entry["priority"])
+
+        environments = manifest["environments"]
+        self.assertEqual(environments["fourfront-mastertest"]["priority"], "orange")
+        self.assertEqual(environments["fourfront-webprod"]["priority"], "green")
+        # Mastertest's summer shutdown is the next (indeed, the only) change coming up.
+        self.assertEqual(environments["fourfront-mastertest"]["next_transition"][:10], "2020-09-01")
+        self.assertIsNone(environments["fourfront-webprod"]["next_transition"])
+        self.assertEqual(manifest["next_transition"], environments["fourfront-mastertest"]["next_transition"])
+
+    def test_snapshot_file_name(self):
+        self.assertEqual(render_snapshots.snapshot_file_name("fourfront-webprod", "html"), "fourfront-webprod.html")
+        self.assertEqual(render_snapshots.snapshot_file_name("../some env", "json"), ".._some_env.json")
+
+
+class TestCompileCalendar(unittest.TestCase):
+
+    def test_event_problems(self):
+        for event in SAMPLE_EVENTS:
+            self.assertEqual(compile_calendar.event_problems(event), [])
+        self.assertEqual(compile_calendar.event_problems("an event"), [(True, "An event must be a dictionary.")])
+
+        def problems(**changes):
+            event = dict(SAMPLE_FF_SUMMER_NOTICE, **changes)
+            return [(is_error, description) for is_error, description in compile_calendar.event_problems(event)]
+
+        self.assertEqual(problems(color="red"), [(False, "Unexpected field 'color'.")])
+        self.assertEqual(problems(name=""), [(True, "The name is required and must be a string.")])
+        self.assertEqual(problems(priority="purple"),
+                         [(True, "The priority must be one of green, yellow, orange, red.")])
+        self.assertEqual(problems(start_time="soon"),
+                         [(True, "The start_time, 'soon', is not a <datetime-string>.")])
+        self.assertEqual(problems(end_time="2020-01-01 00:00:00"),
+                         [(False, "The event ends before it starts, so it will never be shown.")])
+        self.assertEqual(problems(lead_time={"weeks": 1}),
+                         [(True, "A lead_time dictionary can only have the fields days, hours, minutes, seconds.")])
+        self.assertEqual(problems(lead_time="1 hour"),
+                         [(True, "The lead_time must be a number of seconds or a dictionary.")])
+        self.assertEqual(problems(affects={"environments": "fourfront-wolf"}),
+                         [(True, "The affected environments must be a list of strings.")])
+
+    def test_compile_calendar_file(self):
+        self.assertEqual(compile_calendar.compile_calendar_file({"events": []}),
+                         ([(None, True, 'A calendar must be a dictionary with a "calendar" list.')], None))
+
+        # Each problem is reported with the index of its event, and an error means nothing is compiled.
+        bad = {"calendar": [SAMPLE_FF_SYSTEM_UPGRADE,
+                            dict(SAMPLE_FF_SUMMER_NOTICE, color="red"),
+                            dict(SAMPLE_FF_SUMMER_NOTICE, end_time="whenever")]}
+        self.assertEqual(compile_calendar.compile_calendar_file(bad),
+                         ([(1, False, "Unexpected field 'color'."),
+                           (2, True, "The end_time, 'whenever', is not a <datetime-string>.")],
+                          None))
+
+        # Warnings alone don't stop it from being compiled.
+        data = {"calendar": SAMPLE_EVENTS + [dict(SAMPLE_FF_SUMMER_NOTICE, color="red")]}
+        problems, compiled = compile_calendar.compile_calendar_file(data)
+        self.assertEqual(problems, [(3, False, "Unexpected field 'color'.")])
+        self.assertEqual(compiled["calendar"], data["calendar"])
+        self.assertNotIn(lambda_function.PRECOMPILED_KEY, data)  # The data itself isn't changed.
+
+        # The precompiled events are accepted by the lambda, and are the same as it would have compiled.
+        loaded = lambda_function.load_precompiled_events(json.loads(json.dumps(compiled)))
+        expected = [lambda_function.compile_event(i, event) for i, event in enumerate(data["calendar"])]
+        self.assertEqual([(e.index, e.event, e.start, e.end, e.priority, e.environments) for e in loaded],
+                         [(e.index, e.event, e.start, e.end, e.priority, e.environments) for e in expected])
+
+        # Once the calendar is edited, they no longer pass the digest check.
+        edited = dict(compiled, calendar=[dict(event) for event in compiled["calendar"]])
+        edited["calendar"][0]["end_time"] = "2020-03-01 12:00:00-0500"
+        self.assertIsNone(lambda_function.load_precompiled_events(edited))
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as folder:
+            calendar_file = os.path.join(folder, "calendar.json")
+            output_file = os.path.join(folder, "calendar-compiled.json")
+            with open(calendar_file, 'w') as fp:
+                json.dump({"calendar": SAMPLE_EVENTS}, fp)
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                compile_calendar.main([calendar_file, "-o", output_file, "--now", "2020-07-01 12:00:00"])
+            # The February event had ended more than 30 days before, so it's left out.
+            self.assertIn("Compiled 2 events", output.getvalue())
+            with open(output_file) as fp:
+                compiled = json.load(fp)
+            self.assertEqual([e.event for e in lambda_function.load_precompiled_events(compiled)], SAMPLE_EVENTS[1:])
+
+            with open(calendar_file, 'w') as fp:
+                json.dump({"calendar": [dict(SAMPLE_FF_SUMMER_NOTICE, priority="purple")]}, fp)
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                with self.assertRaises(SystemExit) as exit_info:
+                    compile_calendar.main([calendar_file, "--check"])
+            self.assertEqual(exit_info.exception.code, 1)
+            self.assertIn("ERROR: event 0 (Fourfront Mastertest Summer Shutdown): The priority must be",
+                          output.getvalue())
+
+
+class TestPruneCalendar(unittest.TestCase):
+
+    # The system upgrade ended on 2020-02-28, and the summer notices end on 2020-09-01.
+    PRUNE_NOW = "2020-04-15 12:00:00-0400"
+
+    UNPARSEABLE_EVENT = dict(SAMPLE_FF_SYSTEM_UPGRADE, name="Unparseable", end_time="some day")
+    OPEN_ENDED_EVENT = dict(SAMPLE_FF_SYSTEM_UPGRADE, name="Open-Ended", end_time=None)
+
+    def test_prune_calendar(self):
+        data = {"calendar": SAMPLE_EVENTS + [self.UNPARSEABLE_EVENT, self.OPEN_ENDED_EVENT]}
+        pruned, expired = prune_calendar.prune_calendar(data, now=self.PRUNE_NOW)
+        # Events that are still active, never end, or can't be compiled (so no one knows when they end) are kept.
+        self.assertEqual(expired, [SAMPLE_FF_SYSTEM_UPGRADE])
+        self.assertEqual(pruned["calendar"], data["calendar"][1:])
+        self.assertEqual(len(data["calendar"]), 5)  # The data itself isn't changed.
+        self.assertNotIn(lambda_function.PRECOMPILED_KEY, pruned)
+
+        # An event is kept until it has been over for keep_ended_days.
+        pruned, expired = prune_calendar.prune_calendar(data, now=self.PRUNE_NOW, keep_ended_days=60)
+        self.assertEqual(expired, [])
+        self.assertEqual(pruned["calendar"], data["calendar"])
+
+    def test_prune_precompiled_calendar(self):
+        _, compiled = compile_calendar.compile_calendar_file({"calendar": SAMPLE_EVENTS})
+        pruned, expired = prune_calendar.prune_calendar(compiled, now=self.PRUNE_NOW)
+        self.assertEqual(expired, [SAMPLE_FF_SYSTEM_UPGRADE])
+        # The precompiled records are redone to match the events that are left.
+        self.assertNotEqual(pruned[lambda_function.PRECOMPILED_KEY], compiled[lambda_function.PRECOMPILED_KEY])
+        loaded = lambda_function.load_precompiled_events(json.loads(json.dumps(pruned)))
+        self.assertEqual([(e.index, e.event) for e in loaded], list(enumerate(SAMPLE_EVENTS[1:])))
+
+        # Records that no longer match their events are dropped rather than kept.
+        stale = dict(compiled, calendar=SAMPLE_EVENTS[1:])
+        pruned, _ = prune_calendar.prune_calendar(stale, now=self.PRUNE_NOW)
+        self.assertNotIn(lambda_function.PRECOMPILED_KEY, pruned)
+
+    def test_archive_events(self):
+        with tempfile.TemporaryDirectory() as folder:
+            archive_file = os.path.join(folder, "calendar-archive.json")
+            self.assertEqual(prune_calendar.archive_events(archive_file, [SAMPLE_FF_SYSTEM_UPGRADE]), 1)
+            # Archiving the same events again (even as copies, with their keys in another order) adds nothing.
+            reordered = dict(reversed(list(SAMPLE_FF_SYSTEM_UPGRADE.items())))
+            self.assertEqual(prune_calendar.archive_events(archive_file, [SAMPLE_FF_SYSTEM_UPGRADE]), 0)
+            self.assertEqual(prune_calendar.archive_events(archive_file, [reordered]), 0)
+            self.assertEqual(prune_calendar.archive_events(archive_file, [reordered, SAMPLE_FF_SUMMER_NOTICE]), 1)
+            with open(archive_file) as fp:
+                self.assertEqual(json.load(fp), {"calendar": [SAMPLE_FF_SYSTEM_UPGRADE, SAMPLE_FF_SUMMER_NOTICE]})
+
+
+class TestServeLocally(unittest.TestCase):
+
+    def test_lambda_handler_result(self):
+        result = {
+            "statusCode": 200,
+            "headers": {"Content-Type": "text/plain"},
+            "multiValueHeaders": {"X-Thing": ["a", "b"]},
+            "cookies": ["c=1"],
+            "body": "aGk=",
+            "isBase64Encoded": True,
+            "Access-Control-Allow-Origin": "*",
+        }
+        with mock.patch.object(lambda_function, "lambda_handler", return_value=result):
+            with mock.patch.object(serve_locally, "_warned_keys", set()):
+                with contextlib.redirect_stderr(io.StringIO()) as errors:
+                    for _ in range(2):
+                        self.assertEqual(serve_locally.lambda_handler_result({}), {
+                            "statusCode": 200,
+                            "headers": [("Content-Type", "text/plain"), ("X-Thing", "a"), ("X-Thing", "b"),
+                                        ("Set-Cookie", "c=1")],
+                            "body": b"hi",
+                        })
+        # Like API Gateway, it ignores what it doesn't understand, but it says so (once).
+        self.assertEqual(errors.getvalue(), "WARNING: API Gateway ignores 'Access-Control-Allow-Origin'"
+                                            " in lambda_handler's result, so it is not sent.\n")
+
+        with mock.patch.object(lambda_function, "lambda_handler", return_value={"message": "oops"}):
+            self.assertEqual(serve_locally.lambda_handler_result({}),
+                             {"statusCode": 200, "headers": [("Content-Type", "application/json")],
+                              "body": b'{"message": "oops"}'})